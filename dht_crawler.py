@@ -1,7 +1,9 @@
+import time
 from multiprocessing import Process
 
 from dht_crawler_config import *
 from service.crawler import start_crawler
+from service.dht.crawler.seen_filter import SeenFilter
 
 
 def start_crawlers(web_server_api_url, nodes_info):
@@ -12,11 +14,15 @@ def start_crawlers(web_server_api_url, nodes_info):
     """
     processes = []
 
+    # Shared by all forked crawlers, so each info_hash is reported once per window
+    seen_filter = SeenFilter(window=SEEN_FILTER_WINDOW)
+
     for node_info in nodes_info:
         args = {
             "web_server_api_url": web_server_api_url,
             "port": node_info["port"],
-            "node_id": node_info["node_id"]
+            "node_id": node_info["node_id"],
+            "seen_filter": seen_filter
         }
 
         p = Process(target=start_crawler, kwargs=args)
@@ -24,7 +30,14 @@ def start_crawlers(web_server_api_url, nodes_info):
 
         processes.append(p)
 
-    # Wait until all processes end
+    # Wait until all processes end, report duplicated sightings meanwhile
+    while any(map(lambda process: process.is_alive(), processes)):
+        time.sleep(SEEN_FILTER_REPORT_INTERVAL)
+
+        stats = seen_filter.stats()
+        print "info_hashes checked: {0}, suppressed: {1} ({2:.1%})".format(
+            stats["checked"], stats["suppressed"], stats["suppression_rate"])
+
     map(lambda process: process.join(), processes)
 
 
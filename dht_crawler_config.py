@@ -2,3 +2,7 @@ WEB_SERVER_API_URL = "http://127.0.0.1:8081/api"
 
 DHT_CRAWLER_NODES_INFO = map(lambda port: {"port": port, "node_id": None},
                              xrange(6981, 6991))
+
+# Info_hash seen again within this number of seconds is not reported to web server api
+SEEN_FILTER_WINDOW = 10 * 60
+SEEN_FILTER_REPORT_INTERVAL = 60
@@ -0,0 +1,132 @@
+import json
+from collections import deque
+from urllib import urlencode
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+
+def _to_unicode(value):
+    # Torrent names and paths are raw bytes, mostly (but not always) utf-8, json can encode unicode only
+    return value if isinstance(value, unicode) else str(value).decode("utf-8", "replace")
+
+
+class IndexerApiClient(object):
+    """
+    Non-blocking web server api client for metadata loader, runs inside twisted reactor.
+
+    Info_hashes for loading are prefetched into local queue (refilled in background when
+    it becomes shorter than "low_watermark"), loaded metadata is queued and posted in background
+    in batches over a pool of keep-alive connections. While api is slow or down, prefetch is paused
+    as soon as "max_results" metadata documents are waiting, so queue stays bounded.
+    """
+
+    def __init__(self, api_url, fetch_size=50, low_watermark=20, concurrency=4, idle_delay=5, store_size=20,
+                 max_results=1000):
+        """
+        :param api_url: web server api url
+        :param fetch_size: info_hashes count requested at once
+        :param low_watermark: prefetch new info_hashes, when local queue is shorter
+        :param concurrency: max simultaneous requests (and persistent connections) to api
+        :param idle_delay: seconds to wait before next prefetch, when api has no info_hashes for loading
+        :param store_size: max metadata documents posted at once
+        :param max_results: max metadata documents waiting for posting, oldest are dropped above it
+        """
+        self._api_url = api_url
+        self._fetch_size = fetch_size
+        self._low_watermark = low_watermark
+        self._concurrency = concurrency
+        self._idle_delay = idle_delay
+        self._store_size = store_size
+
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = concurrency
+        self._agent = Agent(reactor, pool=pool)
+
+        self._torrents = deque()
+        self._fetching = False
+        self._next_fetch_time = 0
+
+        self._max_results = max_results
+        self._results = deque(maxlen=max_results)
+        self._requests_count = 0
+
+    def _request(self, method, path, params=None, data=None):
+        url = "{0}/{1}".format(self._api_url, path)
+        if params:
+            url += "?" + urlencode(params)
+
+        if data is not None:
+            headers = Headers({"Content-Type": ["application/x-www-form-urlencoded"]})
+            body = FileBodyProducer(StringIO(urlencode(data)))
+        else:
+            headers, body = None, None
+
+        d = self._agent.request(method, url, headers, body)
+        d.addCallback(readBody)
+        d.addCallback(json.loads)
+        return d
+
+    def fetch_next(self):
+        """
+        :return: next info_hash item for loading ({"info_hash": "hex", "peers": [...]}) or None
+        """
+        item = self._torrents.popleft() if self._torrents else None
+
+        if len(self._torrents) < self._low_watermark:
+            self._prefetch()
+
+        return item
+
+    def _prefetch(self):
+        if self._fetching or reactor.seconds() < self._next_fetch_time:
+            return
+
+        if len(self._results) >= self._max_results // 2:
+            # Loaded metadata isn't posted fast enough, don't load more until queue drains
+            return
+
+        self._fetching = True
+
+        d = self._request("GET", "fetch_torrents_for_load",
+                          params={"limit": self._fetch_size, "with_peers": "true"})
+        d.addCallback(self._on_fetched)
+        d.addErrback(lambda error: self._on_fetched({}))
+
+    def _on_fetched(self, api_response):
+        self._fetching = False
+
+        results = api_response.get("result", None)
+        if results and isinstance(results, list):
+            self._torrents.extend(results)
+        else:
+            self._next_fetch_time = reactor.seconds() + self._idle_delay
+
+    def store_metadata(self, metadata):
+        try:
+            data = {"name": _to_unicode(metadata["name"]),
+                    "files": map(lambda f: {"path": map(_to_unicode, f["path"]),
+                                            "length": f["length"]},
+                                 metadata["files"])}
+        except (KeyError, TypeError):  # Malformed metadata
+            return
+
+        self._results.append((metadata["info_hash"], data))
+        self._flush()
+
+    def _flush(self):
+        while self._results and self._requests_count < self._concurrency:
+            self._requests_count += 1
+
+            batch = dict(self._results.popleft() for _ in xrange(min(len(self._results), self._store_size)))
+
+            d = self._request("POST", "add_torrents", data={"info_hashes": json.dumps(batch.keys()),
+                                                            "metadata": json.dumps(batch)})
+            d.addErrback(lambda error: None)  # Ignore any exceptions.
+            d.addBoth(self._on_stored)
+
+    def _on_stored(self, _):
+        self._requests_count -= 1
+        self._flush()
@@ -1,91 +1,164 @@
-from twisted.internet import reactor
+from collections import deque, OrderedDict
+from twisted.internet import reactor, defer
 from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.error import ConnectError
 from protocol import BitTorrentProtocol
+from peer_cache import PeerCache
 
 
-class ConnectionLink:
-    def __init__(self, peers, info_hash, peer_id, on_metadata_loaded, on_metadata_not_found):
-        self._info_hash = info_hash
-        self._peer_id = peer_id
-        self._on_metadata_loaded = on_metadata_loaded
-        self._on_metadata_not_found = on_metadata_not_found
+class ConnectionScheduler:
+    """
+    Process-wide owner of outbound peer connections.
 
-        self._got_metadata = False
+    Keeps total number of open connections under "max_connections" and hands free
+    connection slots to waiting chains in round-robin order, so one info_hash with
+    hundreds of peers can't starve the others.
+    Also remembers peers quality ("peer_cache") for all chains.
+    """
 
-        self._connections = {}
+    def __init__(self, max_connections=200, peer_cache=None):
+        self.peer_cache = peer_cache or PeerCache()
 
-        for peer in peers:
-            self._connections[peer] = None
+        self._max_connections = max_connections
+        self._active = 0
+        self._waiting = deque()  # Chains waiting for connection slot
 
-    def _forget_connection(self, peer):
-        if self._connections.pop(peer, None):
-            if not self._connections and not self._got_metadata and callable(self._on_metadata_not_found):
-                self._on_metadata_not_found()
+    def submit(self, chain):
+        self._waiting.append(chain)
+        self._dispatch()
 
-    def _on_got_metadata(self, peer, metadata, torrent_hash):
-        # Used for callback "_on_metadata_loaded" once.
-        can_callback = False
+    def release(self):
+        self._active -= 1
+        self._dispatch()
 
-        if not self._got_metadata:
-            self._got_metadata = True
-            can_callback = True
+    def _dispatch(self):
+        while self._active < self._max_connections and self._waiting:
+            chain = self._waiting.popleft()
 
-        self._forget_connection(peer)
+            # Slot is taken before connecting, connection may be released synchronously
+            self._active += 1
 
-        if can_callback and callable(self._on_metadata_loaded):
-            self._on_metadata_loaded(metadata, torrent_hash)
+            if not chain.connect_next():
+                self._active -= 1
 
-    def connect(self):
-        for peer in self._connections.keys():
-            peer_ip, peer_port = peer
-
-            point = TCP4ClientEndpoint(reactor, peer_ip, peer_port, 10)
-
-            conn = connectProtocol(
-                point, BitTorrentProtocol(
-                    info_hash=self._info_hash,
-                    peer_id=self._peer_id,
-                    on_metadata_loaded=self._on_metadata_loaded,
-                    on_error=lambda error: self._forget_connection(peer)
-                )
-            )
-            conn.addCallback(lambda protocol: protocol.sendHandshake())
+            if chain.can_connect():
+                self._waiting.append(chain)
+            else:
+                chain.unqueue()
 
-            self._connections[peer] = conn
+    def get_active_count(self):
+        return self._active
 
 
 class ConnectionChain:
-    def __init__(self, peers, info_hash, peer_id, on_metadata_loaded, on_metadata_not_found=None, link_size=10):
+    def __init__(self, peers, info_hash, peer_id, on_metadata_loaded, on_metadata_not_found=None, concurrency=10,
+                 scheduler=None):
+        """
+        :param concurrency: max simultaneous connections for this info_hash
+        :param scheduler: shared ConnectionScheduler, private one is created if omitted
+        """
+        self._info_hash = info_hash
+        self._peer_id = peer_id
         self._on_metadata_loaded = on_metadata_loaded
         self._on_metadata_not_found = on_metadata_not_found
+        self._concurrency = concurrency
+        self._scheduler = scheduler or ConnectionScheduler(concurrency)
+
+        # Known good peers are tried first, known bad are skipped
+        self._peers = deque(self._scheduler.peer_cache.sort_peers(OrderedDict.fromkeys(peers)))
+        self._connections = {}  # peer -> connecting Deferred or connected BitTorrentProtocol
 
-        self._links = []
         self._got_metadata = False
+        self._finished = False
+        self._queued = False
+
+    def connect(self):
+        self._enqueue()
+
+    def can_connect(self):
+        return not self._got_metadata and len(self._peers) > 0 and len(self._connections) < self._concurrency
+
+    def unqueue(self):
+        self._queued = False
+        self._check_finished()
 
-        for i in xrange(0, len(peers), link_size):
-            self._links.append(
-                ConnectionLink(
-                    peers=peers[i:i + link_size],
-                    info_hash=info_hash,
-                    peer_id=peer_id,
-                    on_metadata_loaded=self._on_got_metadata,
-                    on_metadata_not_found=self._connect_next_link
-                )
+    def connect_next(self):
+        # Called by scheduler when connection slot is available
+        if not self.can_connect():
+            return False
+
+        peer = self._peers.popleft()
+        peer_ip, peer_port = peer
+
+        point = TCP4ClientEndpoint(reactor, peer_ip, peer_port, 10)
+
+        conn = connectProtocol(
+            point, BitTorrentProtocol(
+                info_hash=self._info_hash,
+                peer_id=self._peer_id,
+                on_metadata_loaded=lambda metadata, torrent_hash: self._on_got_metadata(peer, metadata, torrent_hash),
+                on_error=lambda error: self._on_error(peer, error),
+                on_extended_handshake=lambda: self._scheduler.peer_cache.mark_good(peer)
             )
+        )
 
-    def connect(self):
-        self._connect_next_link()
+        self._connections[peer] = conn
+
+        conn.addCallback(self._on_connected, peer)
+        conn.addErrback(lambda error: self._on_error(peer, error))
+
+        return True
+
+    def _on_connected(self, protocol, peer):
+        if peer in self._connections:
+            self._connections[peer] = protocol
+            protocol.sendHandshake()
+        else:
+            protocol.transport.abortConnection()
+
+    def _enqueue(self):
+        if not self._queued and self.can_connect():
+            self._queued = True
+            self._scheduler.submit(self)
+        else:
+            self._check_finished()
+
+    def _forget_connection(self, peer):
+        if peer in self._connections:
+            del self._connections[peer]
 
-    def _on_got_metadata(self, metadata, torrent_hash):
-        self._got_metadata = True
+            self._scheduler.release()
+            self._enqueue()
 
-        if callable(self._on_metadata_loaded):
-            self._on_metadata_loaded(metadata, torrent_hash)
+    def _on_error(self, peer, error):
+        # Remember unreachable peers, peers without "ut_metadata" support (11) and timed out (10) ones
+        if error.check(ConnectError) or isinstance(error.value, tuple) and error.value[0] in (10, 11):
+            self._scheduler.peer_cache.mark_bad(peer)
 
-    def _connect_next_link(self):
+        self._forget_connection(peer)
+
+    def _cancel_connections(self):
+        # Metadata is already loaded, other connections of this chain are useless
+        for peer, conn in self._connections.items():
+            if isinstance(conn, defer.Deferred):
+                conn.cancel()
+            else:
+                conn.transport.abortConnection()
+
+    def _on_got_metadata(self, peer, metadata, torrent_hash):
         if not self._got_metadata:
-            if self._links:
-                link = self._links.pop(0)
-                link.connect()
-            elif callable(self._on_metadata_not_found):
+            self._got_metadata = True
+
+            self._forget_connection(peer)
+            self._cancel_connections()
+
+            if callable(self._on_metadata_loaded):
+                self._on_metadata_loaded(metadata, torrent_hash)
+
+    def _check_finished(self):
+        if not self._finished and not self._got_metadata and not self._connections and not self._peers \
+                and not self._queued:
+            self._finished = True
+
+            if callable(self._on_metadata_not_found):
                 self._on_metadata_not_found()
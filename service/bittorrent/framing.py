@@ -0,0 +1,65 @@
+from struct import unpack_from
+
+
+class FrameBuffer(object):
+    """
+    Receive buffer for length-prefixed peer wire messages.
+
+    Incoming data is appended to one reusable bytearray, messages are returned as memoryview
+    slices of it and consumed data is only discarded (compacted) when read offset grows large,
+    so buffering costs are linear in the received data size.
+
+    Returned views should be released before next "feed" call, otherwise unconsumed data is copied.
+    """
+
+    def __init__(self, compact_threshold=64 * 1024):
+        """
+        :param compact_threshold: consumed bytes count, which triggers buffer compaction
+        """
+        self._data = bytearray()
+        self._offset = 0
+        self._compact_threshold = compact_threshold
+
+    def __len__(self):
+        return len(self._data) - self._offset
+
+    def _compact(self):
+        del self._data[:self._offset]
+        self._offset = 0
+
+    def feed(self, data):
+        try:
+            if self._offset == len(self._data):
+                # Everything consumed, reuse allocated memory from the beginning
+                del self._data[:]
+                self._offset = 0
+            elif self._offset >= self._compact_threshold:
+                self._compact()
+
+            self._data.extend(data)
+        except BufferError:
+            # Some returned view is still alive, leave old bytearray to it
+            self._data = self._data[self._offset:]
+            self._offset = 0
+            self._data.extend(data)
+
+    def skip(self, size):
+        self._offset += min(size, len(self))
+
+    def messages(self):
+        """
+        Iterate over complete messages (4-byte big-endian length prefix), skipping keep-alives.
+
+        :return: generator of memoryview message bodies
+        """
+        while len(self) >= 4:
+            msg_len = unpack_from("!I", self._data, self._offset)[0]
+
+            if len(self) < msg_len + 4:
+                break
+
+            start = self._offset + 4
+            self._offset = start + msg_len
+
+            if msg_len:
+                yield memoryview(self._data)[start: start + msg_len]
@@ -0,0 +1,68 @@
+from hashlib import sha1
+
+METADATA_PIECE_SIZE = 16 * 1024
+METADATA_MAX_SIZE = 8 * 1024 * 1024  # Larger info dictionaries are rejected
+
+
+class MetadataAssembler(object):
+    """
+    Collects "ut_metadata" pieces into preallocated buffer.
+
+    Pieces are written at their offsets as they arrive (in any order), contiguous prefix
+    of received pieces is hashed incrementally, so completion check costs nothing.
+    Raises ValueError on sizes inconsistent with announced "metadata_size".
+    """
+
+    def __init__(self, info_hash, metadata_size, max_size=METADATA_MAX_SIZE):
+        if not isinstance(metadata_size, (int, long)) or not 0 < metadata_size <= max_size:
+            raise ValueError("Invalid metadata size")
+
+        self._info_hash = info_hash
+        self.size = metadata_size
+        self.pieces_count = (metadata_size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE
+
+        self._data = bytearray(metadata_size)
+        self._received = [False] * self.pieces_count
+        self._remaining = self.pieces_count
+
+        self._hashed_count = 0
+        self._hash = sha1()
+
+    def _piece_range(self, index):
+        start = index * METADATA_PIECE_SIZE
+        return start, min(start + METADATA_PIECE_SIZE, self.size)
+
+    def add_piece(self, index, data, total_size=None):
+        """
+        :return: True if all pieces received
+        """
+        if total_size is not None and total_size != self.size:
+            raise ValueError("Inconsistent metadata size")
+
+        if not isinstance(index, (int, long)) or not 0 <= index < self.pieces_count:
+            raise ValueError("Invalid metadata piece index")
+
+        start, end = self._piece_range(index)
+        if len(data) != end - start:
+            raise ValueError("Invalid metadata piece length")
+
+        if not self._received[index]:
+            self._data[start: end] = data
+            self._received[index] = True
+            self._remaining -= 1
+
+            while self._hashed_count < self.pieces_count and self._received[self._hashed_count]:
+                start, end = self._piece_range(self._hashed_count)
+                self._hash.update(buffer(self._data, start, end - start))
+                self._hashed_count += 1
+
+        return self.is_complete()
+
+    def is_complete(self):
+        return self._remaining == 0
+
+    def is_valid(self):
+        return self.is_complete() and self._hash.digest() == self._info_hash
+
+    def get_metadata(self):
+        return str(self._data)
@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+
+
+class PeerCache(object):
+    """
+    Peers quality memory shared between info_hashes.
+
+    Peers with recent successful "ut_metadata" extended handshake are kept in bounded LRU and
+    tried first, peers which failed (no extensions, timeouts, refused connections) are skipped
+    for "bad_ttl" seconds.
+    """
+
+    def __init__(self, good_size=10000, bad_size=50000, bad_ttl=30 * 60):
+        self._good_size = good_size
+        self._bad_size = bad_size
+        self._bad_ttl = bad_ttl
+
+        self._good = OrderedDict()  # peer -> None, oldest first
+        self._bad = OrderedDict()  # peer -> expiration time, oldest first
+
+    def mark_good(self, peer):
+        self._bad.pop(peer, None)
+        self._good.pop(peer, None)
+        self._good[peer] = None
+
+        if len(self._good) > self._good_size:
+            self._good.popitem(last=False)
+
+    def mark_bad(self, peer):
+        self._good.pop(peer, None)
+        self._bad.pop(peer, None)
+        self._bad[peer] = time.time() + self._bad_ttl
+
+        if len(self._bad) > self._bad_size:
+            self._bad.popitem(last=False)
+
+    def is_good(self, peer):
+        return peer in self._good
+
+    def is_bad(self, peer):
+        expiration_time = self._bad.get(peer, None)
+
+        if expiration_time is not None and expiration_time < time.time():
+            del self._bad[peer]
+            return False
+
+        return expiration_time is not None
+
+    def sort_peers(self, peers):
+        """
+        :return: list of peers without known bad ones, known good peers first (order is kept otherwise)
+        """
+        return sorted(filter(lambda peer: not self.is_bad(peer), peers),
+                      key=lambda peer: not self.is_good(peer))
@@ -1,22 +1,25 @@
 # Source code from https://github.com/bashkirtsevich/Py-ut_metadata
 
-from struct import pack, unpack
+from struct import pack
 from binascii import unhexlify
 from bencode import bencode, bdecode, decode_dict
-from time import sleep
-from hashlib import sha1
 from twisted.internet import protocol, defer
 from twisted.protocols import policies
+from framing import FrameBuffer
+from metadata import MetadataAssembler
 
 
 class BitTorrentProtocol(protocol.Protocol, policies.TimeoutMixin):
-    def __init__(self, info_hash, peer_id, on_metadata_loaded, on_error):
+    def __init__(self, info_hash, peer_id, on_metadata_loaded, on_error, on_extended_handshake=None):
         self._info_hash = info_hash
         self._peer_id = peer_id
+        self._on_extended_handshake = on_extended_handshake
 
-        self._buffer = buffer("")
+        self._buffer = FrameBuffer()
         self._read_handshake = True
-        self._metadata = {}
+        self._metadata = None  # MetadataAssembler, created after extended handshake
+        self._ut_metadata_id = None
+        self._next_piece = 0
 
         self._deferred = defer.Deferred()
         self._deferred.addCallback(on_metadata_loaded, info_hash)
@@ -26,7 +29,7 @@ class BitTorrentProtocol(protocol.Protocol, policies.TimeoutMixin):
     def parseMessage(message):
         # Return message code and message data
         if message:
-            return (unpack("B", message[:1])[0], message[1:])
+            return (ord(message[0]), message[1:])
         else:
             return None
 
@@ -47,9 +50,12 @@ class BitTorrentProtocol(protocol.Protocol, policies.TimeoutMixin):
             # If he send extended message, we can  time
             self.resetTimeout()
 
+            # Extended message body is copied once, other messages are never copied
+            msg_type, msg_data = ord(msg_data[0]), msg_data[1:].tobytes()
+
             # Extended handshake
-            if ord(msg_data[0]) == 0:
-                hs_data = bdecode(msg_data[1:])
+            if msg_type == 0 and self._metadata is None:
+                hs_data = bdecode(msg_data)
 
                 if "metadata_size" in hs_data and "m" in hs_data and "ut_metadata" in hs_data["m"]:
                     metadata_size = hs_data["metadata_size"]
@@ -63,63 +69,85 @@ class BitTorrentProtocol(protocol.Protocol, policies.TimeoutMixin):
                         "reqq": 255
                     }
 
+                    try:
+                        self._metadata = MetadataAssembler(self._info_hash, metadata_size)
+                    except ValueError as e:
+                        self.abort(14, str(e))
+                        return
+
+                    self._ut_metadata_id = ut_metadata_id
+
+                    if callable(self._on_extended_handshake):
+                        self._on_extended_handshake()
+
                     # Response extended handshake
                     self.sendExtendedMessage(0, hs_response)
 
-                    sleep(0.5)
-
-                    # Request metadata
-                    for i in range(0, 1 + metadata_size / (16 * 1024)):
-                        self.sendExtendedMessage(ut_metadata_id, {"msg_type": 0, "piece": i})
-                        sleep(0.05)
+                    # Pipeline piece requests, keeping no more outstanding than peer allows ("reqq")
+                    reqq = hs_data.get("reqq", self._metadata.pieces_count)
+                    self.requestPieces(reqq if isinstance(reqq, (int, long)) and reqq > 0 else 1)
                 else:
-                    self._deferred.errback((11, "Peer has no necessary protocol extensions"))
-                    self.transport.loseConnection()
+                    self.abort(11, "Peer has no necessary protocol extensions")
 
-            elif ord(msg_data[0]) == 1:
-                r, l = decode_dict(msg_data[1:], 0)
+            elif msg_type == 1 and self._metadata is not None:
+                r, l = decode_dict(msg_data, 0)
 
                 if r["msg_type"] == 1:
-                    self._metadata[r["piece"]] = msg_data[l + 1:]
-
-                    metadata = reduce(lambda r, e: r + self._metadata[e], sorted(self._metadata.keys()), "")
-
-                    if len(metadata) == r["total_size"]:
-                        if sha1(metadata).digest() == self._info_hash:
-                            self._deferred.callback(bdecode(metadata))
+                    try:
+                        completed = self._metadata.add_piece(r["piece"], msg_data[l:], r.get("total_size"))
+                    except ValueError as e:
+                        self.abort(14, str(e))
+                        return
+
+                    if completed:
+                        if self._metadata.is_valid():
+                            self._deferred.callback(bdecode(self._metadata.get_metadata()))
                         else:
                             self._deferred.errback((12, "Wrong metadata hash"))
 
                         # Abort connection anyway
                         self.transport.loseConnection()
+                    else:
+                        self.requestPieces(1)
+
+                elif r["msg_type"] == 2:
+                    self.abort(15, "Peer rejected metadata request")
+
+    def requestPieces(self, count):
+        for i in xrange(self._next_piece, min(self._next_piece + count, self._metadata.pieces_count)):
+            self.sendExtendedMessage(self._ut_metadata_id, {"msg_type": 0, "piece": i})
+            self._next_piece = i + 1
+
+    def abort(self, error_code, error_message):
+        if not self._deferred.called:
+            self._deferred.errback((error_code, error_message))
+
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.setTimeout(None)
+
+        if not self._deferred.called:
+            self._deferred.errback((13, "Connection lost"))
 
     def connectionMade(self):
         # Set connection timeout in 10 seconds (after 10 seconds idle connection will be aborted)
         self.setTimeout(10)
 
     def dataReceived(self, data):
-        self._buffer = buffer(self._buffer) + buffer(data)
+        self._buffer.feed(data)
 
         if self._read_handshake:
             if len(self._buffer) >= 68:
                 # Skip handshake response
-                self._buffer = self._buffer[68:]
+                self._buffer.skip(68)
                 self._read_handshake = False
             else:
                 return
-        else:
-            # Read regular message
-            while len(self._buffer) >= 4:
-                msg_len = unpack("!I", self._buffer[:4])[0]
 
-                if len(self._buffer) >= msg_len + 4:
-                    message = self.parseMessage(self._buffer[4: msg_len + 4])
-                    if message:
-                        self.handleMessage(*message)
-
-                    self._buffer = self._buffer[msg_len + 4:]
-                else:
-                    break
+        # Read regular messages
+        for message in self._buffer.messages():
+            self.handleMessage(*self.parseMessage(message))
 
     def timeoutConnection(self):
         if not self._deferred.called:
@@ -1,4 +1,6 @@
 from binascii import hexlify, unhexlify
+from threading import Condition, Thread
+import time
 import requests
 import json
 from dht.common_utils import generate_node_id
@@ -69,17 +71,140 @@ def __store_routing_table(web_server_api_url, local_node_id, address, buckets):
         print "__store_routing_table error"
 
 
-def __store_info_hash(web_server_api_url, info_hash):
-    try:
-        requests.post("{0}/add_torrent".format(web_server_api_url),
-                      data={"info_hash": hexlify(info_hash)})
-    except:
-        print "__store_info_hash error"
+class InfoHashBuffer(object):
+    """
+    Write-behind buffer for info_hash sightings.
+    Hashes (with sightings count and announced peers) are collected from receive thread and posted
+    in batches from own thread, so packet handling never waits for web server api.
+    Sightings of hashes suppressed by seen filter are counted too and posted with each batch, so
+    popularity of hashes is counted for all their sightings.
+    """
+
+    def __init__(self, web_server_api_url, batch_size=500, flush_interval=5.0, max_pending=50000,
+                 max_peers=8):
+        """
+        :param web_server_api_url: web server api url
+        :param batch_size: flush as soon as this number of hashes collected
+        :param flush_interval: flush pending hashes at least each "flush_interval" seconds
+        :param max_pending: new hashes are dropped while api is unreachable and buffer is full
+        :param max_peers: max announced peers kept per info_hash in one batch
+        """
+        self._url = "{0}/add_torrents".format(web_server_api_url)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._max_peers = max_peers
+
+        self._pending = {}  # info_hash -> [sightings count, set of announced (host, port)]
+        self._sightings = {}  # info_hash -> sightings count of suppressed (not pending) hashes
+        self._condition = Condition()
+        self._session = requests.Session()  # Keep-alive connection to api server
+
+    def add(self, info_hash, peer=None):
+        with self._condition:
+            if info_hash in self._pending or len(self._pending) < self._max_pending:
+                item = self._pending.setdefault(info_hash, [0, set()])
+                item[0] += 1
+
+                if peer and len(item[1]) < self._max_peers:
+                    item[1].add(peer)
+
+            if len(self._pending) >= self._batch_size:
+                self._condition.notify()
+
+    def touch(self, info_hash):
+        # Count sighting of info_hash suppressed by seen filter
+        with self._condition:
+            item = self._pending.get(info_hash, None)
+            if item:
+                item[0] += 1
+            elif info_hash in self._sightings or len(self._sightings) < self._max_pending:
+                self._sightings[info_hash] = self._sightings.get(info_hash, 0) + 1
+
+    def _take_batch(self):
+        with self._condition:
+            deadline = time.time() + self._flush_interval
+
+            while len(self._pending) < self._batch_size and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+
+            sightings, self._sightings = self._sightings, {}
+
+            return [self._pending.popitem() for _ in xrange(min(len(self._pending), self._batch_size))], sightings
 
+    def _flush(self, batch, sightings):
+        """
+        :param sightings: dict of info_hash -> sightings count of hashes suppressed by seen filter
+        :return: True if api server accepted batch
+        """
+        # Posted info_hashes count as seen once, unless they have sightings count
+        sightings = dict(sightings)
+        for info_hash, (count, _) in batch:
+            if count > 1 or info_hash in sightings:
+                sightings[info_hash] = sightings.get(info_hash, 0) + count
 
-def start_crawler(web_server_api_url, port, node_id=None):
+        try:
+            response = self._session.post(
+                self._url,
+                data={"info_hashes": json.dumps(map(lambda item: hexlify(item[0]), batch)),
+                      "sightings": json.dumps({hexlify(info_hash): count
+                                               for info_hash, count in sightings.iteritems()}),
+                      "peers": json.dumps({hexlify(info_hash): list(peers)
+                                           for info_hash, (_, peers) in batch if peers})})
+
+            if not response.ok:
+                print "InfoHashBuffer flush error: HTTP {0}".format(response.status_code)
+
+            return response.ok
+        except requests.RequestException as e:
+            print "InfoHashBuffer flush error: {0}".format(e)
+            return False
+
+    def _requeue(self, batch, sightings):
+        # Not posted hashes are returned to buffer (seen filter won't report them again), buffer stays bounded
+        with self._condition:
+            for info_hash, count in sightings.iteritems():
+                if info_hash in self._sightings or len(self._sightings) < self._max_pending:
+                    self._sightings[info_hash] = self._sightings.get(info_hash, 0) + count
+
+            for info_hash, (count, peers) in batch:
+                if info_hash in self._pending or len(self._pending) < self._max_pending:
+                    item = self._pending.setdefault(info_hash, [0, set()])
+                    item[0] += count
+                    item[1].update(list(peers)[:max(self._max_peers - len(item[1]), 0)])
+
+    def __worker(self):
+        while True:
+            batch, sightings = self._take_batch()
+            if (batch or sightings) and not self._flush(batch, sightings):
+                self._requeue(batch, sightings)
+                # Don't hammer unavailable api server
+                time.sleep(self._flush_interval)
+
+    def start(self):
+        worker_thread = Thread(target=self.__worker)
+        worker_thread.daemon = True
+        worker_thread.start()
+
+
+def start_crawler(web_server_api_url, port, node_id=None, seen_filter=None):
     routing_table = __try_load_routing_table(web_server_api_url, "0.0.0.0", port, node_id)
 
+    info_hash_buffer = InfoHashBuffer(web_server_api_url)
+    info_hash_buffer.start()
+
+    def store_info_hash(info_hash, peer=None):
+        if peer and not (isinstance(peer[1], (int, long)) and 0 < peer[1] < 65536):
+            peer = None
+
+        # Announces carry peer endpoint for metadata loader, so they are never suppressed
+        is_new = seen_filter is None or seen_filter.check_and_add(info_hash)
+
+        if is_new or peer:
+            info_hash_buffer.add(info_hash, peer)
+        else:
+            info_hash_buffer.touch(info_hash)
+
     arguments = {
         "node_id": routing_table["local_node_id"],
         "routing_table": routing_table["buckets"],
@@ -90,10 +215,10 @@ def start_crawler(web_server_api_url, port, node_id=None):
             __store_routing_table(web_server_api_url, local_node_id, address, routing_table),
         "on_get_peers":
             lambda info_hash:
-            __store_info_hash(web_server_api_url, info_hash),
+            store_info_hash(info_hash),
         "on_announce":
             lambda info_hash, announce_host, announce_port:
-            __store_info_hash(web_server_api_url, info_hash)
+            store_info_hash(info_hash, (announce_host, announce_port))
     }
 
     protocol = DHTProtocol(**arguments)
@@ -9,3 +9,5 @@ INITIAL_NODES = [
 ]
 
 UDP_SERVER_BANDWIDTH = 128 * 1024  # 128 KBps
+UDP_SERVER_PACKET_RATE = 1000  # Packets per second
+UDP_SERVER_QUEUE_SIZE = 2048  # Max packets waiting in each send queue (oldest are dropped)
@@ -10,37 +10,74 @@ from utils import get_routing_table_index
 from utils import xor
 from utils import encode_nodes
 from utils import decode_nodes
+from utils import TokenBucket
 from ..common_utils import generate_node_id
 
-from threading import Lock, Thread
-from config import INITIAL_NODES, UDP_SERVER_BANDWIDTH
+from collections import deque
+from threading import Lock, Thread, Condition
+from config import INITIAL_NODES, UDP_SERVER_BANDWIDTH, UDP_SERVER_PACKET_RATE, UDP_SERVER_QUEUE_SIZE
 from bencode import bencode, bdecode
 
 
 class UDPServer(object):
-    def __init__(self, address):
+    PRIORITY_RESPONSE = 0
+    PRIORITY_QUERY = 1
+
+    def __init__(self, address, bandwidth=UDP_SERVER_BANDWIDTH, packet_rate=UDP_SERVER_PACKET_RATE,
+                 queue_size=UDP_SERVER_QUEUE_SIZE):
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.__socket.bind(address)
 
-        self._latency = 0.04
-        self._bandwidth = UDP_SERVER_BANDWIDTH
-        self._bytes_sent = 0
-        self._time_created = time.time()
+        self._bytes_bucket = TokenBucket(bandwidth)
+        self._packets_bucket = TokenBucket(packet_rate)
+
+        # Responses to remote queries are always sent before our own discovery queries.
+        # Full queue drops its oldest packet (deque maxlen behaviour).
+        self._queues = (deque(maxlen=queue_size), deque(maxlen=queue_size))
+        self._queues_condition = Condition()
 
     def __del__(self):
         self.__socket.close()
 
-    def _send(self, data, address):
-        try:
-            self._bytes_sent += len(data)
+    def _send(self, data, address, priority=PRIORITY_QUERY):
+        with self._queues_condition:
+            self._queues[priority].append((data, address))
+            self._queues_condition.notify_all()
 
-            connection_duration = time.time() - self._time_created
-            required_duration = self._bytes_sent / self._bandwidth
-            time.sleep(max(required_duration - connection_duration, self._latency))
+    def _wait_send_queue(self, priority=PRIORITY_QUERY):
+        # Block until queue has a free slot, used for throttling packet producers
+        with self._queues_condition:
+            queue = self._queues[priority]
+            while len(queue) >= queue.maxlen:
+                self._queues_condition.wait()
 
-            self.__socket.sendto(data, address)
-        except:
-            pass
+    def _dispatch(self):
+        while True:
+            with self._queues_condition:
+                queue = next((q for q in self._queues if q), None)
+                if queue is None:
+                    self._queues_condition.wait()
+                    continue
+
+                data, address = queue[0]
+
+                delay = max(self._packets_bucket.delay(1),
+                            self._bytes_bucket.delay(len(data)))
+                if delay > 0:
+                    # Wake up earlier if response packet will be queued
+                    self._queues_condition.wait(delay)
+                    continue
+
+                queue.popleft()
+                self._packets_bucket.consume(1)
+                self._bytes_bucket.consume(len(data))
+
+                self._queues_condition.notify_all()
+
+            try:
+                self.__socket.sendto(data, address)
+            except:
+                pass
 
     def _receive(self):
         try:
@@ -71,8 +108,11 @@ class DHTProtocol(UDPServer):
 
         self.routing_table_lock = Lock()
 
-    def _send_message(self, message, address):
-        self._send(bencode(message), address)
+    def _send_message(self, message, address, priority=UDPServer.PRIORITY_QUERY):
+        self._send(bencode(message), address, priority)
+
+    def _send_response(self, message, address):
+        self._send_message(message, address, UDPServer.PRIORITY_RESPONSE)
 
     def find_closest_nodes(self, target_id, k_value=8):
         with self.routing_table_lock:
@@ -122,7 +162,7 @@ class DHTProtocol(UDPServer):
             }
         }
 
-        self._send_message(response, address)
+        self._send_response(response, address)
 
         if self._on_ping is not None:
             self._on_ping()
@@ -151,7 +191,7 @@ class DHTProtocol(UDPServer):
             }
         }
 
-        self._send_message(response, address)
+        self._send_response(response, address)
 
         if self._on_find_nodes is not None:
             self._on_find_nodes(target_node_id)
@@ -169,7 +209,7 @@ class DHTProtocol(UDPServer):
             }
         }
 
-        self._send_message(response, address)
+        self._send_response(response, address)
 
         if self._on_get_peers is not None:
             self._on_get_peers(info_hash)
@@ -177,9 +217,10 @@ class DHTProtocol(UDPServer):
     def handle_announce_peer_query(self, data, address):
         arguments = data["a"]
         info_hash = arguments["info_hash"]
-        port = arguments["port"]
 
-        host, _ = address
+        # BEP 5: with "implied_port" (clients behind NAT) announced port is ignored, UDP source port is used
+        host, source_port = address
+        port = source_port if arguments.get("implied_port", 0) else arguments["port"]
 
         response = {
             "t": data["t"],
@@ -189,7 +230,7 @@ class DHTProtocol(UDPServer):
             }
         }
 
-        self._send_message(response, address)
+        self._send_response(response, address)
 
         if self._on_announce is not None:
             self._on_announce(info_hash, host, port)
@@ -246,6 +287,9 @@ class DHTProtocol(UDPServer):
         rt_save_timestamp = time.time()
 
         while True:
+            # Discovery is throttled by send scheduler, wait until it can accept new queries
+            self._wait_send_queue()
+
             target_id = generate_node_id()
             for node in self.find_closest_nodes(target_id):
                 self.find_node(node, target_id)
@@ -275,9 +319,12 @@ class DHTProtocol(UDPServer):
     def start(self):
         client_thread = Thread(target=self.__client)
         server_thread = Thread(target=self.__server)
+        dispatch_thread = Thread(target=self._dispatch)
 
         client_thread.start()
         server_thread.start()
+        dispatch_thread.start()
 
         client_thread.join()
         server_thread.join()
+        dispatch_thread.join()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import mmap
+import struct
+import time
+
+from multiprocessing import Lock
+
+
+class SeenFilter(object):
+    """
+    Rotating Bloom filter of recently seen info_hashes, shared between crawler processes.
+
+    Filter lives in anonymous shared mmap, so it must be created before crawler processes are forked.
+    Two generations are kept: lookups check both, inserts go to current one, and each "window"
+    seconds the older generation is cleared and becomes current. Hash which was not seen during
+    last window passes through the filter again.
+    """
+
+    # rotated_at, current generation, checked counter, suppressed counter
+    HEADER = struct.Struct("dIQQ")
+    GENERATIONS = 2
+
+    def __init__(self, bits=2 ** 23, hashes_count=4, window=10 * 60):
+        """
+        :param bits: bits per generation (power of two)
+        :param hashes_count: number of bit positions per info_hash, up to 5
+        :param window: generation lifetime in seconds
+        """
+        assert bits & (bits - 1) == 0 and 0 < hashes_count <= 5
+
+        self._mask = bits - 1
+        self._hashes_count = hashes_count
+        self._window = window
+        self._generation_size = bits / 8
+
+        self._lock = Lock()
+        self._mm = mmap.mmap(-1, SeenFilter.HEADER.size + SeenFilter.GENERATIONS * self._generation_size)
+        self._write_header(time.time(), 0, 0, 0)
+
+    def _read_header(self):
+        return SeenFilter.HEADER.unpack_from(self._mm, 0)
+
+    def _write_header(self, *header):
+        SeenFilter.HEADER.pack_into(self._mm, 0, *header)
+
+    def _positions(self, info_hash):
+        # info_hash is a sha1 digest already, so its 32-bit words are independent uniform hashes
+        words = struct.unpack_from("!5I", info_hash)
+        return map(lambda word: word & self._mask, words[:self._hashes_count])
+
+    def _generation_offset(self, generation):
+        return SeenFilter.HEADER.size + generation * self._generation_size
+
+    def _test(self, generation, positions):
+        offset = self._generation_offset(generation)
+        return all(map(lambda p: ord(self._mm[offset + (p >> 3)]) & (1 << (p & 7)), positions))
+
+    def _set(self, generation, positions):
+        offset = self._generation_offset(generation)
+        for p in positions:
+            index = offset + (p >> 3)
+            self._mm[index] = chr(ord(self._mm[index]) | (1 << (p & 7)))
+
+    def _clear(self, generation):
+        offset = self._generation_offset(generation)
+        self._mm[offset: offset + self._generation_size] = "\x00" * self._generation_size
+
+    def check_and_add(self, info_hash):
+        """
+        :param info_hash: 20-byte info_hash
+        :return: True if info_hash is seen first time in window (and should be reported)
+        """
+        if not isinstance(info_hash, str) or len(info_hash) != 20:
+            return False
+
+        positions = self._positions(info_hash)
+
+        with self._lock:
+            rotated_at, current, checked, suppressed = self._read_header()
+
+            now = time.time()
+            if now - rotated_at >= self._window:
+                current = (current + 1) % SeenFilter.GENERATIONS
+                rotated_at = now
+                self._clear(current)
+
+            seen = any(map(lambda g: self._test(g, positions), xrange(SeenFilter.GENERATIONS)))
+            if not self._test(current, positions):
+                self._set(current, positions)
+
+            self._write_header(rotated_at, current, checked + 1, suppressed + int(seen))
+
+        return not seen
+
+    def stats(self):
+        _, _, checked, suppressed = self._read_header()
+
+        return {"checked": checked,
+                "suppressed": suppressed,
+                "suppression_rate": float(suppressed) / checked if checked else 0.0}
@@ -2,6 +2,7 @@
 # coding=utf-8
 
 import math
+import time
 import socket
 import struct
 from random import randint
@@ -58,3 +59,29 @@ def get_routing_table_index(distance):
         return 0
     else:
         return int(math.floor(math.log(math.fabs(distance), 2.0)))
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens added per second
+        :param capacity: max tokens accumulated while idle (one second of rate by default)
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def delay(self, amount):
+        # Seconds to wait until "amount" tokens are available (bursts larger than capacity are clipped)
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
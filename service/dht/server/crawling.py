@@ -1,5 +1,7 @@
 from collections import Counter
 
+from twisted.internet import defer, reactor
+
 from log import Logger
 from utils import deferred_dict
 from utils import decode_nodes, decode_values
@@ -63,23 +65,107 @@ class SpiderCrawl(object):
 
 
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha):
+    def __init__(self, protocol, node, peers, ksize, alpha, max_peers=None, timeout=None, on_peers=None):
+        """
+        Args:
+            max_peers: Stop crawling, when this number of unique peers is found (crawl all nearest nodes if None)
+            timeout: Stop crawling after this number of seconds (no deadline if None)
+            on_peers: Called with list of new unique peers as soon as any node returns them
+        """
         SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
         # keep track of the single nearest node without value - per
         # section 2.3 so we can set the key there if found
         self.nearestWithoutValue = NodeHeap(self.node, 1)
         self.values = []
+        self.max_peers = max_peers
+        self.timeout = timeout
+        self.on_peers = on_peers
+
+        self.seenValues = set()
+        self.outstanding = {}  # peer id -> get_peers RPC Deferred
+        self.result = None
+        self.deadline = None
 
     def find(self):
         """
         Find either the closest nodes or the value requested.
         """
-        return self._find(self.protocol.callGetPeers)
+        if self.result is None:
+            self.result = defer.Deferred()
+
+            if self.timeout:
+                self.deadline = reactor.callLater(self.timeout, self._finish)
+
+        if not self.result.called:
+            # Error of any round (e.g. in "on_peers" or response handling) fails the whole lookup
+            self._find(self._callGetPeers).addErrback(self._finish)
+
+        return self.result
+
+    def _callGetPeers(self, peer, node):
+        d = self.protocol.callGetPeers(peer, node)
+        self.outstanding[peer.id] = d
+
+        d.addCallback(self._responseReceived, peer.id)
+        d.addErrback(self._rpcFailed, peer)
+        return d
+
+    def _rpcFailed(self, failure, peer):
+        # Cancelled RPC is the same as not responded one, any other error (e.g. in "on_peers" or response
+        # handling) fails the whole lookup, round gets not responded peer anyway
+        if not failure.check(defer.CancelledError):
+            self._finish(failure)
+
+        return False, None, peer
+
+    def _responseReceived(self, result, peerid):
+        self.outstanding.pop(peerid, None)
+
+        response = RPCFindResponse(result)
+        if response.happened() and response.hasValues() and not self.result.called:
+            self._addValues(response.getValues())
+
+        return result
+
+    def _addValues(self, values):
+        newValues = []
+        for value in values:
+            if value not in self.seenValues:
+                self.seenValues.add(value)
+                newValues.append(value)
+
+        self.values.extend(newValues)
+
+        if newValues and callable(self.on_peers):
+            self.on_peers(newValues)
+
+        if self.max_peers and len(self.values) >= self.max_peers:
+            self._finish()
+
+    def _finish(self, failure=None):
+        if self.result.called:
+            return
+
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+
+        if failure is None:
+            self.result.callback(list(self.values))  # unique list of values (if found, otherwise empty list)
+        else:
+            self.result.errback(failure)
+
+        # Result is fired first, so cancelled round doesn't start next one
+        outstanding, self.outstanding = self.outstanding, {}
+        for d in outstanding.values():
+            d.cancel()
 
     def _nodesFound(self, responses):
         """
         Handle the result of an iteration in _find.
         """
+        if self.result.called:
+            return
+
         toremove = []
 
         for peerid, response in responses.items():
@@ -88,9 +174,6 @@ class ValueSpiderCrawl(SpiderCrawl):
             if not response.happened():
                 toremove.append(peerid)
 
-            elif response.hasValues():
-                self.values.extend(response.getValues())
-
             if response.hasNodeList():
                 peer = self.nearest.getNodeById(peerid)
                 self.nearestWithoutValue.push(peer)
@@ -99,9 +182,9 @@ class ValueSpiderCrawl(SpiderCrawl):
         self.nearest.remove(toremove)
 
         if self.nearest.allBeenContacted():
-            return list(set(self.values))  # return unique list of values (if found, otherwise return empty list)
+            self._finish()
         else:
-            return self.find()
+            self.find()
 
 
 class NodeSpiderCrawl(SpiderCrawl):
@@ -130,16 +130,24 @@ class Server(object):
             ds[addr] = self.protocol.ping(addr, self.node.id)
         return deferred_dict(ds).addCallback(init_table)
 
-    def get_peers(self, info_hash):
+    def get_peers(self, info_hash, max_peers=None, timeout=None, on_peers=None):
         """
         Get a key if the network has it.
 
+        Args:
+            max_peers: Return as soon as this number of unique peers is found, outstanding queries are cancelled
+            timeout: Return peers found in this number of seconds
+            on_peers: Called with new peers as soon as they arrive
+
         Returns:
             :class:`None` if not found, the value otherwise.
         """
         # if this node has it, return it
-        if self.storage.get(info_hash) is not None:
-            return defer.succeed(self.storage.get(info_hash))
+        values = self.storage.get(info_hash)
+        if values is not None:
+            if callable(on_peers):
+                on_peers(values)
+            return defer.succeed(values)
 
         node = Node(info_hash)
         nearest = self.protocol.router.findNeighbors(node)
@@ -147,7 +155,7 @@ class Server(object):
             self.log.warning("There are no known neighbors to get key %s" % info_hash)
             return defer.succeed(None)
 
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
+        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, max_peers, timeout, on_peers)
         return spider.find()
 
     def announce_peer(self, info_hash, port):
@@ -1,13 +1,42 @@
-from operator import itemgetter
-import heapq
+from binascii import hexlify
+from bisect import bisect_left
 
 
-class Node:
+# Recently seen node ids -> (interned id, long id), the same nodes are decoded from many responses
+_ids_cache = {}
+_IDS_CACHE_SIZE = 100000
+
+
+def intern_id(id):
+    """
+    Get (interned id, long id) for node id, long id of recently seen ids isn't converted again.
+    """
+    item = _ids_cache.get(id, None)
+
+    if item is None:
+        if len(_ids_cache) >= _IDS_CACHE_SIZE:
+            _ids_cache.clear()
+
+        item = _ids_cache[id] = (id, long(hexlify(id), 16))
+
+    return item
+
+
+class Node(object):
+    __slots__ = ("id", "ip", "port", "long_id")
+
     def __init__(self, id, ip=None, port=None):
         self.id = id
         self.ip = ip
         self.port = port
-        self.long_id = long(id.encode('hex'), 16)
+
+    def __getattr__(self, name):
+        # Called for unset "long_id" slot only, it's computed on first use (most of decoded nodes are never
+        # compared), then read from slot directly
+        if name == "long_id":
+            self.id, self.long_id = intern_id(self.id)
+            return self.long_id
+        raise AttributeError(name)
 
     def sameHomeAs(self, node):
         return self.ip == node.ip and self.port == node.port
@@ -22,7 +51,7 @@ class Node:
         """
         Enables use of Node as a tuple - i.e., tuple(node) works.
         """
-        return iter([self.id, self.ip, self.port])
+        return iter((self.id, self.ip, self.port))
 
     def __repr__(self):
         return repr([self.long_id, self.ip, self.port])
@@ -33,19 +62,35 @@ class Node:
 
 class NodeHeap(object):
     """
-    A heap of nodes ordered by distance to a given node.
+    Nodes ordered by distance to a given node.
+
+    Nodes are kept in a sorted list of (distance, id) bounded by "capacity" along with an id -> node
+    index, so membership check is O(1) and push / remove are O(log n) searches. The visible view of
+    "maxsize" closest nodes is cached until it changes.
     """
-    def __init__(self, node, maxsize):
+    def __init__(self, node, maxsize, capacity=None):
         """
         Constructor.
 
         @param node: The node to measure all distnaces from.
         @param maxsize: The maximum size that this heap can grow to.
+        @param capacity: The maximum number of nodes kept, farther ones are dropped (4 * maxsize by default).
         """
         self.node = node
-        self.heap = []
         self.contacted = set()
         self.maxsize = maxsize
+        self.capacity = max(capacity or maxsize * 4, maxsize)
+
+        self._entries = []  # Sorted (distance, id)
+        self._nodes = {}  # id -> node
+        self._view = None  # Cached "maxsize" closest nodes
+
+    def _removeAt(self, index):
+        _, id = self._entries.pop(index)
+        del self._nodes[id]
+
+        if index < self.maxsize:
+            self._view = None
 
     def remove(self, peerIDs):
         """
@@ -55,20 +100,13 @@ class NodeHeap(object):
         removal of nodes may not change the visible size as previously added
         nodes suddenly become visible.
         """
-        peerIDs = set(peerIDs)
-        if len(peerIDs) == 0:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peerIDs:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for id in set(peerIDs):
+            node = self._nodes.get(id, None)
+            if node is not None:
+                self._removeAt(bisect_left(self._entries, (self.node.distanceTo(node), id)))
 
     def getNodeById(self, id):
-        for _, node in self.heap:
-            if node.id == id:
-                return node
-        return None
+        return self._nodes.get(id, None)
 
     def allBeenContacted(self):
         return len(self.getUncontacted()) == 0
@@ -81,7 +119,9 @@ class NodeHeap(object):
 
     def popleft(self):
         if len(self) > 0:
-            return heapq.heappop(self.heap)[1]
+            node = self._nodes[self._entries[0][1]]
+            self._removeAt(0)
+            return node
         return None
 
     def push(self, nodes):
@@ -94,22 +134,33 @@ class NodeHeap(object):
             nodes = [nodes]
 
         for node in nodes:
-            if node not in self:
-                distance = self.node.distanceTo(node)
-                heapq.heappush(self.heap, (distance, node))
+            if node.id in self._nodes:
+                continue
+
+            entry = (self.node.distanceTo(node), node.id)
+            if len(self._entries) >= self.capacity and entry > self._entries[-1]:
+                continue
+
+            index = bisect_left(self._entries, entry)
+            self._entries.insert(index, entry)
+            self._nodes[node.id] = node
+
+            if index < self.maxsize:
+                self._view = None
+
+            if len(self._entries) > self.capacity:
+                self._removeAt(len(self._entries) - 1)
 
     def __len__(self):
-        return min(len(self.heap), self.maxsize)
+        return min(len(self._entries), self.maxsize)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        if self._view is None:
+            self._view = [self._nodes[id] for _, id in self._entries[:self.maxsize]]
+        return iter(self._view)
 
     def __contains__(self, node):
-        for distance, n in self.heap:
-            if node.id == n.id:
-                return True
-        return False
+        return node.id in self._nodes
 
     def getUncontacted(self):
         return [n for n in self if n.id not in self.contacted]
@@ -101,12 +101,18 @@ class KademliaProtocol(RPCProtocol):
 
         self.transport.write(bencode(message), address)
 
-        d = defer.Deferred()
+        d = defer.Deferred(canceller=lambda _: self._cancelMessage(msgID))
         timeout = reactor.callLater(self._waitTimeout, self._timeout, msgID)
 
         self._outstanding[msgID] = (d, timeout)
         return d
 
+    def _cancelMessage(self, msgID):
+        # Caller doesn't wait for response anymore, late response is ignored
+        if msgID in self._outstanding:
+            _, timeout = self._outstanding.pop(msgID)
+            timeout.cancel()
+
     def getRefreshIDs(self):
         """
         Get ids to search for to keep old buckets up to date.
@@ -1,6 +1,7 @@
 import heapq
 import time
 import operator
+from bisect import bisect_left
 from collections import OrderedDict
 
 from utils import OrderedSet, shared_prefix
@@ -78,6 +79,9 @@ class KBucket(object):
 
 
 class RoutingTable(object):
+    # Tables with few buckets are scanned linearly by "findNeighbors"
+    SMALL_TABLE_BUCKETS = 4
+
     def __init__(self, protocol, ksize, node):
         """
         @param node: The node that represents this server.  It won't
@@ -91,11 +95,14 @@ class RoutingTable(object):
 
     def flush(self):
         self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        # Sorted upper bounds of buckets ranges, bucket lookup is a bisection
+        self.bucketsUpperBounds = [2 ** 160]
 
     def splitBucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.bucketsUpperBounds.insert(index, one.range[1])
 
     def getLonelyBuckets(self):
         """
@@ -132,16 +139,62 @@ class RoutingTable(object):
         """
         Get the index of the bucket that the given node would fall into.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
+        return bisect_left(self.bucketsUpperBounds, node.long_id)
 
     def findNeighbors(self, node, k=None, exclude=None):
-        nodes = []
-        # Linear scan by buckets and nodes. Find any closest neighbor (including far nodes).
-        for bucket in self.buckets:
+        """
+        Get up to k nodes closest to the given node, nearest first.
+
+        Buckets are visited outward from the bucket of the given node. Any node id in bucket to the right
+        (left) of it differs from the given node id in the highest bit of "bucket lower (upper) bound ^ id"
+        or higher, so visiting stops once the remaining buckets can't hold nodes closer than k-th found one.
+        """
+        k = k or self.ksize
+
+        def isCandidate(neighbor):
+            return neighbor.id != node.id and (exclude is None or not neighbor.sameHomeAs(exclude))
+
+        if len(self.buckets) <= self.SMALL_TABLE_BUCKETS:
+            # Small table, linear scan is cheaper
+            nodes = [(node.distanceTo(neighbor), neighbor)
+                     for bucket in self.buckets for neighbor in bucket.getNodes() if isCandidate(neighbor)]
+            return map(operator.itemgetter(1), heapq.nsmallest(k, nodes))
+
+        nearest = []  # Max-heap of k closest nodes, (-distance, node)
+
+        def visit(bucket):
             for neighbor in bucket.getNodes():
-                if neighbor.id != node.id and (exclude is None or not neighbor.sameHomeAs(exclude)):
-                    heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
+                if isCandidate(neighbor):
+                    distance = node.distanceTo(neighbor)
+                    if len(nearest) < k:
+                        heapq.heappush(nearest, (-distance, neighbor))
+                    elif distance < -nearest[0][0]:
+                        heapq.heapreplace(nearest, (-distance, neighbor))
+
+        def minDistance(index, bound):
+            if 0 <= index < len(self.buckets):
+                return 1 << ((self.buckets[index].range[bound] ^ node.long_id).bit_length() - 1)
+
+        index = self.getBucketFor(node)
+        visit(self.buckets[index])
+
+        left, right = index - 1, index + 1
+        leftDistance, rightDistance = minDistance(left, 1), minDistance(right, 0)
+
+        while leftDistance is not None or rightDistance is not None:
+            goLeft = rightDistance is None or leftDistance is not None and leftDistance < rightDistance
+            distance = leftDistance if goLeft else rightDistance
+
+            if len(nearest) >= k and distance >= -nearest[0][0]:
+                break
+
+            if goLeft:
+                visit(self.buckets[left])
+                left -= 1
+                leftDistance = minDistance(left, 1)
+            else:
+                visit(self.buckets[right])
+                right += 1
+                rightDistance = minDistance(right, 0)
 
-        return map(operator.itemgetter(1), heapq.nsmallest(k or self.ksize, nodes))
+        return map(operator.itemgetter(1), sorted(nearest, reverse=True))
@@ -1,6 +1,7 @@
 from binascii import hexlify, unhexlify
+from functools import partial
 from twisted.internet import reactor
-from bittorrent.bittorrent import ConnectionChain
+from bittorrent.bittorrent import ConnectionChain, ConnectionScheduler
 from dht.server.network import Server
 from dht.common_utils import generate_node_id, generate_peer_id
 
@@ -17,27 +18,53 @@ def __torrent_loaded(metadata, info_hash, on_torrent_loaded):
         on_torrent_loaded(args)
 
 
-def __handle_peers(peers, info_hash, server, on_get_info_hash, on_got_metadata):
+def __lookup_failed(failure, info_hash):
+    # Next lookup is started anyway
+    print "Peers lookup of {0} failed: {1}".format(hexlify(info_hash), failure.getErrorMessage())
+    return []
+
+
+def __connect_peers(peers, info_hash, scheduler, on_got_metadata, on_metadata_not_found=None, delay=1):
     if peers:
         chain = ConnectionChain(peers, info_hash,
                                 peer_id=generate_peer_id(),
                                 on_metadata_loaded=lambda metadata, torrent_hash:
                                 __torrent_loaded(metadata, torrent_hash, on_got_metadata),
-                                link_size=10)
+                                on_metadata_not_found=on_metadata_not_found,
+                                concurrency=10,
+                                scheduler=scheduler)
+
+        reactor.callLater(delay, chain.connect)
+    elif callable(on_metadata_not_found):
+        on_metadata_not_found()
+
 
-        reactor.callLater(1, chain.connect)
+def __handle_peers(peers, info_hash, get_peers, scheduler, on_get_info_hash, on_got_metadata):
+    __connect_peers(peers, info_hash, scheduler, on_got_metadata)
 
-    reactor.callLater(1, __get_peers_next, server, on_get_info_hash, on_got_metadata)
+    reactor.callLater(1, __get_peers_next, get_peers, scheduler, on_get_info_hash, on_got_metadata)
 
 
-def __get_peers_next(server, on_get_info_hash, on_got_metadata):
-    info_hash = unhexlify(on_get_info_hash() or "")
+def __get_peers_next(get_peers, scheduler, on_get_info_hash, on_got_metadata):
+    item = on_get_info_hash() or {}
+    info_hash = unhexlify(item.get("info_hash", ""))
 
-    if info_hash:
-        server.get_peers(info_hash).addCallback(
-            __handle_peers, info_hash, server, on_get_info_hash, on_got_metadata)
+    # Peers announced to crawler are connected immediately, DHT lookup is used only if they fail
+    seed_peers = map(tuple, item.get("peers", []))
+
+    if info_hash and seed_peers:
+        __connect_peers(seed_peers, info_hash, scheduler, on_got_metadata,
+                        on_metadata_not_found=lambda: get_peers(info_hash).addErrback(
+                            __lookup_failed, info_hash).addCallback(
+                            __connect_peers, info_hash, scheduler, on_got_metadata),
+                        delay=0)
+
+        reactor.callLater(1, __get_peers_next, get_peers, scheduler, on_get_info_hash, on_got_metadata)
+    elif info_hash:
+        get_peers(info_hash).addErrback(__lookup_failed, info_hash).addCallback(
+            __handle_peers, info_hash, get_peers, scheduler, on_get_info_hash, on_got_metadata)
     else:
-        reactor.callLater(1, __get_peers_next, server, on_get_info_hash, on_got_metadata)
+        reactor.callLater(1, __get_peers_next, get_peers, scheduler, on_get_info_hash, on_got_metadata)
 
 
 def __bootstrap_done(found, server, **kwargs):
@@ -52,8 +79,16 @@ def __bootstrap_done(found, server, **kwargs):
         on_got_metadata = kwargs.get("on_got_metadata", None)
 
         if workers_count > 0 and callable(on_get_info_hash) and callable(on_got_metadata):
+            # All workers share one budget of outbound peer connections
+            scheduler = ConnectionScheduler(kwargs.get("max_connections", 200))
+
+            # Metadata is loaded from a few peers, DHT lookup stops as soon as they are found
+            get_peers = partial(server.get_peers,
+                                max_peers=kwargs.get("peers_target", 8),
+                                timeout=kwargs.get("peers_lookup_timeout", 15))
+
             for i in xrange(workers_count):
-                reactor.callLater(1, __get_peers_next, server, on_get_info_hash, on_got_metadata)
+                reactor.callLater(1, __get_peers_next, get_peers, scheduler, on_get_info_hash, on_got_metadata)
     else:
         on_bootstrap_failed = kwargs.get("on_bootstrap_failed", None)
 
@@ -74,7 +109,10 @@ def load_torrent(bootstrap_address, port, **kwargs):
     """
     :param bootstrap_address: DHT-bootstrap host name and port
     :param port: Local DHT-server port
-    :param kwargs: node_id, peer_id, on_bootstrap_done, on_bootstrap_failed
+    :param kwargs: node_id, peer_id, workers_count, max_connections, on_bootstrap_done, on_bootstrap_failed,
+                   on_get_info_hash (returns {"info_hash": "hex", "peers": [(host, port), ...]} or None),
+                   on_got_metadata, peers_target (DHT lookup stops after finding this number of peers),
+                   peers_lookup_timeout (seconds)
     :return: None
     """
 
@@ -0,0 +1,126 @@
+import unittest
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError
+
+from web.api import *
+from web.api import _bulk_upserted_keys
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+INFO_HASH = "01" * 20
+OTHER_INFO_HASH = "02" * 20
+
+
+def make_metadata(name, files_count=1):
+    return {"name": name, "files": [{"path": [u"file{0}".format(i)], "length": i} for i in xrange(files_count)]}
+
+
+class FailingCollection(object):
+    def __init__(self, code):
+        self.code = code
+
+    def bulk_write(self, operations, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": self.code, "errmsg": "error"}],
+                              "upserted": []})
+
+
+class BulkUpsertTest(unittest.TestCase):
+    def test_duplicate_key_errors_are_ignored(self):
+        self.assertEqual(_bulk_upserted_keys(FailingCollection(11000), [None], [INFO_HASH]), set())
+
+    def test_other_write_errors_are_raised(self):
+        self.assertRaises(BulkWriteError, _bulk_upserted_keys, FailingCollection(10334), [None], [INFO_HASH])
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class InsertTorrentsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+
+    def test_insert_is_idempotent(self):
+        timestamp = datetime.utcnow()
+
+        self.assertEqual(db_insert_or_update_torrents(self.db, [(INFO_HASH, None)], timestamp), 1)
+        self.assertEqual(db_insert_or_update_torrents(self.db, [(INFO_HASH, None)], timestamp), 0)
+        self.assertEqual(db_insert_or_update_torrents(self.db, [(INFO_HASH, make_metadata(u"a"))], timestamp), 1)
+
+        self.assertEqual(db_get_hashes_count(self.db), 1)
+        self.assertEqual(db_get_torrents_count(self.db), 1)
+        self.assertTrue(db_torrent_exists(self.db, INFO_HASH, has_metadata=True))
+
+    def test_metadata_of_other_info_hash_is_not_stored(self):
+        metadata = dict(make_metadata(u"a"), info_hash=OTHER_INFO_HASH)
+
+        db_insert_or_update_torrents(self.db, [(INFO_HASH, metadata)], datetime.utcnow())
+
+        self.assertTrue(db_torrent_exists(self.db, INFO_HASH))
+        self.assertFalse(db_torrent_exists(self.db, INFO_HASH, has_metadata=True))
+
+    def test_malformed_files_do_not_fail_batch(self):
+        metadata = {"name": u"b", "files": [{"path": [], "length": u"1"}]}
+
+        db_insert_or_update_torrents(self.db, [(INFO_HASH, make_metadata(u"a")), (OTHER_INFO_HASH, metadata)],
+                                     datetime.utcnow())
+
+        self.assertEqual(db_get_torrents_count(self.db), 2)
+
+    def test_files_chunks_are_written_once(self):
+        metadata = make_metadata(u"a", FILES_INLINE_MAX + FILES_CHUNK_SIZE + 1)
+
+        db_insert_or_update_torrents(self.db, [(INFO_HASH, metadata)], datetime.utcnow())
+        chunks = list(self.db.torrent_files.find(sort=[("index", 1)]))
+        self.assertEqual(len(chunks), 2)
+
+        self.db.torrent_files.update_many({}, {"$set": {"written": 1}})
+        db_insert_or_update_torrents(self.db, [(INFO_HASH, make_metadata(u"b", FILES_CHUNK_SIZE * 3))],
+                                     datetime.utcnow())
+        self.assertEqual(self.db.torrent_files.count({"written": 1}), 2)
+        self.assertEqual(self.db.torrent_files.count(), 2)
+
+        result, _ = db_get_torrent_details(self.db, INFO_HASH)
+        self.assertEqual(result["name"], u"a")
+        self.assertEqual(result["files"], metadata["files"])
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class FetchNotIndexedTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.info_hashes = ["{0:040x}".format(i) for i in xrange(1, 6)]
+
+        timestamp = datetime.utcnow() - timedelta(minutes=1)
+        db_insert_torrents(self.db, self.info_hashes, timestamp,
+                           sightings={info_hash: i + 1 for i, info_hash in enumerate(self.info_hashes)})
+
+    def test_most_sighted_are_claimed_first(self):
+        self.assertEqual(db_fetch_not_indexed_torrents(self.db, size=2), self.info_hashes[:-3:-1])
+
+    def test_claimed_are_leased(self):
+        first = db_fetch_not_indexed_torrents(self.db, size=3)
+        second = db_fetch_not_indexed_torrents(self.db, size=3)
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(sorted(first + second), sorted(self.info_hashes))
+        self.assertEqual(db_fetch_not_indexed_torrents(self.db, size=3), [])
+
+    def test_due_info_hashes_return_into_queue(self):
+        db_fetch_not_indexed_torrents(self.db, size=1)
+        self.assertEqual(self.db.hashes.count({"ready": True}), 4)
+
+        # Lease (and retry delay) passed
+        self.db.hashes.update_many({"ready": False}, {"$set": {"next_attempt_at": datetime.utcnow()}})
+
+        self.assertEqual(sorted(db_fetch_not_indexed_torrents(self.db, size=5)), sorted(self.info_hashes))
+
+    def test_loaded_leave_queue(self):
+        db_insert_or_update_torrents(self.db, [(self.info_hashes[-1], make_metadata(u"a"))], datetime.utcnow())
+
+        self.assertNotIn(self.info_hashes[-1], db_fetch_not_indexed_torrents(self.db, size=10))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from datetime import datetime, timedelta
+
+import web.cache
+from web.cache import TTLCache, MongoCache
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class TTLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self._time = web.cache.time
+        web.cache.time = lambda: self.now
+
+    def tearDown(self):
+        web.cache.time = self._time
+
+    def test_get_set_delete(self):
+        cache = TTLCache(ttl=60, max_size=10)
+
+        cache.set(("details", "a"), {"name": "a"})
+        self.assertEqual(cache.get(("details", "a")), {"name": "a"})
+        self.assertEqual(cache.get(("details", "b"), "missed"), "missed")
+
+        cache.delete(("details", "a"))
+        self.assertIsNone(cache.get(("details", "a")))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "size": 0})
+
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=60, max_size=10)
+        cache.set("a", 1)
+
+        self.now += 59
+        self.assertEqual(cache.get("a"), 1)
+
+        self.now += 2
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = TTLCache(ttl=60, max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class MongoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.result_cache
+        self.cache = MongoCache(self.collection, ttl=60)
+
+    def test_get_set_delete(self):
+        self.cache.set(["search", u"query", 10], {"count": 1})
+        self.assertEqual(self.cache.get(["search", u"query", 10]), {"count": 1})
+
+        self.cache.delete(["search", u"query", 10])
+        self.assertIsNone(self.cache.get(["search", u"query", 10]))
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "size": 0})
+
+    def test_expired_entries_are_missed(self):
+        # TTL index removes them later
+        self.cache.set("a", 1)
+        self.collection.update_one({}, {"$set": {"expire_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_clear(self):
+        self.cache.set("a", 1)
+        self.cache.clear()
+
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import unittest
+from datetime import datetime
+
+import requests
+
+from service.crawler import InfoHashBuffer
+from web.api import db_insert_torrents
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+
+class FakeSession(object):
+    # Records posted forms, answers with given status code or raises given exception
+    def __init__(self, status_code=200, error=None):
+        self.status_code = status_code
+        self.error = error
+        self.posts = []
+
+    def post(self, url, data):
+        self.posts.append(data)
+
+        if self.error:
+            raise self.error
+
+        return FakeResponse(self.status_code)
+
+
+class InfoHashBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = InfoHashBuffer("http://localhost/api", batch_size=10, flush_interval=0, max_pending=3)
+
+    def test_flush_posts_batch(self):
+        self.buffer._session = FakeSession()
+
+        self.buffer.add("\x01" * 20, ("1.2.3.4", 6881))
+        self.buffer.add("\x01" * 20)
+
+        self.assertTrue(self.buffer._flush(*self.buffer._take_batch()))
+
+        form = self.buffer._session.posts[0]
+        self.assertEqual(json.loads(form["info_hashes"]), ["01" * 20])
+        self.assertEqual(json.loads(form["sightings"]), {"01" * 20: 2})
+        self.assertEqual(json.loads(form["peers"]), {"01" * 20: [["1.2.3.4", 6881]]})
+
+    def test_failed_flush_is_requeued(self):
+        for session in (FakeSession(status_code=503), FakeSession(error=requests.ConnectionError())):
+            self.buffer._session = session
+            self.buffer.add("\x01" * 20, ("1.2.3.4", 6881))
+
+            self.buffer.touch("\x02" * 20)
+
+            batch, sightings = self.buffer._take_batch()
+            self.assertFalse(self.buffer._flush(batch, sightings))
+
+            self.buffer._requeue(batch, sightings)
+            self.assertEqual(self.buffer._pending, {"\x01" * 20: [1, {("1.2.3.4", 6881)}]})
+            self.assertEqual(self.buffer._sightings, {"\x02" * 20: 1})
+
+            self.buffer._pending.clear()
+            self.buffer._sightings.clear()
+
+    def test_requeue_is_bounded(self):
+        batch = [(chr(i) * 20, (1, set())) for i in xrange(5)]
+
+        self.buffer._requeue(batch, {})
+        self.assertEqual(len(self.buffer._pending), 3)
+
+    @unittest.skipIf(mongomock is None, "mongomock is not installed")
+    def test_suppressed_sightings_are_counted(self):
+        # Hash is posted once, then seen filter suppresses it, but all sightings reach "db_add_sightings"
+        self.buffer._session = FakeSession()
+        db = mongomock.MongoClient().db
+
+        self.buffer.add("\x01" * 20)
+        self.buffer._flush(*self.buffer._take_batch())
+
+        for _ in xrange(3):
+            self.buffer.touch("\x01" * 20)
+        self.buffer._flush(*self.buffer._take_batch())
+
+        for form in self.buffer._session.posts:
+            db_insert_torrents(db, json.loads(form["info_hashes"]), datetime.utcnow(),
+                               sightings=json.loads(form["sightings"]))
+
+        self.assertEqual(json.loads(self.buffer._session.posts[1]["info_hashes"]), [])
+        self.assertEqual(db.hashes.find_one()["sightings"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import socket
+import struct
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from service.dht.server import crawling
+from service.dht.server.crawling import ValueSpiderCrawl
+from service.dht.server.node import Node
+
+
+def encode_peers(peers):
+    return map(lambda (host, port): socket.inet_aton(host) + struct.pack("!H", port), peers)
+
+
+class FakeProtocol(object):
+    # Keeps get_peers RPC Deferreds to answer them from test
+    def __init__(self):
+        self.calls = {}
+
+    def callGetPeers(self, peer, node):
+        self.calls[peer.id] = defer.Deferred()
+        return self.calls[peer.id]
+
+
+class ValueSpiderCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(crawling, "reactor", self.clock)
+
+        self.protocol = FakeProtocol()
+        self.nodes = [Node(chr(index) * 20, "127.0.0.1", 6881 + index) for index in xrange(1, 4)]
+        self.found = []
+
+    def crawl(self, **kwargs):
+        spider = ValueSpiderCrawl(self.protocol, Node("\0" * 20), self.nodes, 8, 3, on_peers=self.found.extend,
+                                  **kwargs)
+        return spider.find()
+
+    def test_max_peers(self):
+        result = self.crawl(max_peers=2)
+        self.assertEqual(len(self.protocol.calls), 3)
+
+        peers = [("1.2.3.4", 1), ("1.2.3.4", 1), ("5.6.7.8", 2)]
+        self.protocol.calls[self.nodes[0].id].callback((True, {"values": encode_peers(peers)}))
+
+        self.assertEqual(self.successResultOf(result), [("1.2.3.4", 1), ("5.6.7.8", 2)])
+        self.assertEqual(self.found, [("1.2.3.4", 1), ("5.6.7.8", 2)])
+
+        # Outstanding RPCs are cancelled, no next round is started
+        self.assertTrue(all(map(lambda d: d.called, self.protocol.calls.values())))
+        self.assertEqual(len(self.protocol.calls), 3)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_timeout_cancels_lookup(self):
+        result = self.crawl(timeout=15)
+        self.protocol.calls[self.nodes[0].id].callback((True, {"values": encode_peers([("1.2.3.4", 1)])}))
+
+        self.clock.advance(14)
+        self.assertNoResult(result)
+
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(result), [("1.2.3.4", 1)])
+        self.assertTrue(all(map(lambda d: d.called, self.protocol.calls.values())))
+
+    def test_all_nodes_contacted(self):
+        result = self.crawl(timeout=15)
+
+        for d in self.protocol.calls.values():
+            d.callback((False, None))
+
+        self.assertEqual(self.successResultOf(result), [])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_round_error_fails_lookup(self):
+        def on_peers(peers):
+            raise ZeroDivisionError()
+
+        spider = ValueSpiderCrawl(self.protocol, Node("\0" * 20), self.nodes, 8, 3, timeout=15, on_peers=on_peers)
+        result = spider.find()
+
+        self.protocol.calls[self.nodes[0].id].callback((True, {"values": encode_peers([("1.2.3.4", 1)])}))
+
+        # Lookup fails at once, outstanding RPCs are cancelled
+        self.failureResultOf(result, ZeroDivisionError)
+        self.assertTrue(all(map(lambda d: d.called, self.protocol.calls.values())))
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertEqual(self.flushLoggedErrors(), [])
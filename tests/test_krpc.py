@@ -0,0 +1,32 @@
+import unittest
+
+from service.dht.crawler.krpc import DHTProtocol
+
+INFO_HASH = "\1" * 20
+
+
+class AnnouncePeerTest(unittest.TestCase):
+    def setUp(self):
+        self.announces = []
+        self.protocol = DHTProtocol("\0" * 20, [[] for _ in xrange(160)], ("127.0.0.1", 0),
+                                    on_announce=lambda *args: self.announces.append(args))
+
+    def announce(self, arguments):
+        self.protocol.handle_announce_peer_query({"t": "aa", "y": "q", "q": "announce_peer",
+                                                  "a": dict(arguments, id="\2" * 20, info_hash=INFO_HASH)},
+                                                 ("1.2.3.4", 50000))
+
+    def test_announced_port(self):
+        self.announce({"port": 6881})
+        self.announce({"port": 6882, "implied_port": 0})
+
+        self.assertEqual(self.announces, [(INFO_HASH, "1.2.3.4", 6881), (INFO_HASH, "1.2.3.4", 6882)])
+
+    def test_implied_port(self):
+        self.announce({"port": 6881, "implied_port": 1})
+
+        self.assertEqual(self.announces, [(INFO_HASH, "1.2.3.4", 50000)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from binascii import unhexlify
+
+from bson import Binary
+
+from web.schema import check_ids_format
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+INFO_HASH = "01" * 20
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class CheckIdsFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+
+    def test_empty_database_accepts_any_format(self):
+        check_ids_format(self.db, binary_ids=False)
+        check_ids_format(self.db, binary_ids=True)
+
+    def test_matching_format(self):
+        self.db.hashes.insert_one({"info_hash": INFO_HASH})
+        check_ids_format(self.db, binary_ids=False)
+
+        self.assertRaises(RuntimeError, check_ids_format, self.db, True)
+
+    def test_not_converted_database_is_detected(self):
+        # Binary info_hashes were added to database, which still holds hex ones
+        self.db.torrents.insert_one({"info_hash": INFO_HASH})
+        self.db.torrents.insert_one({"info_hash": Binary(unhexlify("02" * 20))})
+
+        self.assertRaises(RuntimeError, check_ids_format, self.db, True)
+        self.assertRaises(RuntimeError, check_ids_format, self.db, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
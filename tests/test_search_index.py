@@ -0,0 +1,228 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from bisect import bisect_left
+
+from bson import ObjectId
+
+import web.api
+from web.api import *
+from web.search_index import tokenize, build_segment, merge_segments, write_segment, Segment, SearchIndex, \
+    MAX_TOKEN_LENGTH, _to_ms
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def make_torrent(name, paths=(), timestamp=0):
+    return ObjectId().binary, timestamp, name, list(paths)
+
+
+def search_all(index, query, limit):
+    # Follow keyset pages of built-in index
+    results, token = [], None
+
+    while True:
+        count, page, _, tokens = db_search_torrents(index.db, query, ["name"], limit=limit, token=token,
+                                                    search_backend=index)
+        results.extend(map(lambda item: item["name"], page))
+
+        token = tokens["next"]
+        if not token:
+            return count, results
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_words_and_episodes(self):
+        self.assertEqual(tokenize(u"Some.Show.S01E02.1080p [Group]"),
+                         [u"some", u"show", u"s01e02", u"s01", u"e02", u"1080p", u"group"])
+
+    def test_long_tokens_are_dropped(self):
+        self.assertEqual(tokenize(u"a " + u"b" * (MAX_TOKEN_LENGTH + 1) + u" " + u"c" * MAX_TOKEN_LENGTH),
+                         [u"a", u"c" * MAX_TOKEN_LENGTH])
+
+
+class SegmentTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def build(self, name, torrents):
+        build_segment(os.path.join(self.path, name), torrents)
+        return Segment(os.path.join(self.path, name))
+
+    def read_postings(self, segment, term):
+        lookup = segment.lookup(term)
+        if not lookup:
+            return []
+
+        docs, freqs = segment.postings(*lookup)
+        return map(lambda number: segment.doc(number)[0], docs)
+
+    def test_round_trip(self):
+        torrents = [make_torrent(u"Old Show", [u"show/file.mkv"], 1000),
+                    make_torrent(u"New Movie", [u"movie.avi", u"extras/show.txt"], 2000)]
+        segment = self.build("a.idx", torrents)
+
+        self.assertEqual((segment.docs_count, segment.min_timestamp, segment.max_timestamp), (2, 1000, 2000))
+        self.assertEqual(map(lambda item: item[0], segment.iter_terms()),
+                         sorted(["avi", "extras", "file", "mkv", "movie", "new", "old", "show", "txt"]))
+
+        # Documents are numbered newest first
+        self.assertEqual(self.read_postings(segment, "show"), [torrents[1][0], torrents[0][0]])
+        self.assertEqual(segment.postings(*segment.lookup("show"))[1].tolist(), [1, 4 + 1])
+        self.assertIsNone(segment.lookup("missing"))
+
+    def test_failed_write_leaves_no_files(self):
+        path = os.path.join(self.path, "a.idx")
+        postings = iter([("a" * 0x10000, web.search_index.array("I", [0]), web.search_index.array("H", [1]))])
+
+        self.assertRaises(Exception, write_segment, path, [(ObjectId().binary, 0, 1)], postings)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_postings_seek(self):
+        # Postings of "a" span several blocks of memory map
+        torrents = [make_torrent(u"a" if index % 3 else u"b", timestamp=index) for index in xrange(1000)]
+        segment = self.build("a.idx", torrents)
+
+        docs, freqs = segment.postings(*segment.lookup("a"))
+        view = segment.postings_view(*segment.lookup("a"))
+
+        self.assertEqual(len(view), len(docs))
+        self.assertEqual(map(lambda index: (view[index], view.freq(index)), xrange(len(docs))), zip(docs, freqs))
+
+        for _ in xrange(1000):
+            number, lo = random.randrange(1002), random.randrange(len(docs) + 1)
+            self.assertEqual(view.seek(number, lo), max(bisect_left(docs, number), lo))
+
+    def test_merge(self):
+        torrents = [make_torrent(u"show {0}".format(index), timestamp=index * 10) for index in xrange(6)]
+        first = self.build("a.idx", torrents[0::2] + torrents[3:4])
+        second = self.build("b.idx", torrents[1::2])
+
+        merge_segments(os.path.join(self.path, "c.idx"), [first, second])
+        merged = Segment(os.path.join(self.path, "c.idx"))
+
+        # Duplicate is dropped, documents are renumbered by timestamp
+        self.assertEqual(merged.docs_count, 6)
+        self.assertEqual(map(lambda number: merged.doc(number)[0], xrange(6)),
+                         map(lambda torrent: torrent[0], reversed(torrents)))
+        self.assertEqual(self.read_postings(merged, "show"), map(lambda torrent: torrent[0], reversed(torrents)))
+        self.assertEqual(self.read_postings(merged, "3"), [torrents[3][0]])
+        self.assertEqual(merged.total_length, first.total_length + second.total_length - 2 * 4)
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = mongomock.MongoClient().db
+        self.timestamp = datetime.utcnow() - timedelta(minutes=1)
+
+        self.index = SearchIndex(self.path, writable=True, merge_factor=2, batch_size=2)
+        self.index.db = self.db
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        web.api.BINARY_IDS = False
+
+    def add(self, name, files=(), timestamp=None):
+        info_hash = os.urandom(20).encode("hex")
+        metadata = {"name": name, "files": map(lambda path: {"path": path.split(u"/"), "length": 1}, files)}
+
+        db_insert_or_update_torrents(self.db, [(info_hash, metadata)], timestamp or self.timestamp)
+        return info_hash
+
+    def update(self):
+        while self.index.update(self.db):
+            pass
+
+    def test_update_pages_through_equal_timestamps(self):
+        # More torrents with the same timestamp than batch size
+        for index in xrange(5):
+            self.add(u"show {0}".format(index))
+        self.add(u"show new", timestamp=datetime.utcnow())
+
+        self.update()
+        self.assertEqual(self.index.search(u"show", 10)[0], 5)
+
+        self.index.merge()
+        self.assertEqual(len(self.index._segments), 2)
+        self.assertEqual(self.index.search(u"show", 10)[0], 5)
+
+    def test_malformed_torrents_are_skipped(self):
+        self.add(u"show good")
+        self.db.torrents.insert_one({"info_hash": "01" * 20, "name": 1, "timestamp": self.timestamp})
+        self.db.torrents.insert_one({"info_hash": "02" * 20, "name": u"show bad", "files": [{"path": [1]}],
+                                     "timestamp": self.timestamp})
+
+        self.update()
+
+        self.assertEqual(self.index.search(u"show", 10)[0], 1)
+        self.assertEqual(self.index.update(self.db), 0)
+
+    def test_files_chunks_of_binary_ids(self):
+        web.api.BINARY_IDS = True
+        self.add(u"archive", [u"dir/file{0}".format(index) for index in xrange(FILES_INLINE_MAX)] + [u"dir/last"])
+
+        self.update()
+
+        self.assertEqual(self.index.search(u"last", 10)[0], 1)
+
+    def test_count_stops_after_max_count(self):
+        for index in xrange(10):
+            self.add(u"show 1080p {0}".format(index), timestamp=self.timestamp - timedelta(hours=index))
+
+        # One segment
+        self.index = SearchIndex(os.path.join(self.path, "single"), writable=True)
+        self.update()
+
+        self.assertEqual(self.index.search(u"show 1080p", 10)[0], 10)
+        self.assertEqual(self.index.search(u"show 1080p", 10, max_ranked=2, max_count=3)[0], 4)
+        self.assertEqual(self.index.search(u"show", 10, max_ranked=2, max_count=3)[0], 10)
+
+        # Newest matches are ranked
+        self.assertEqual(map(lambda item: item[1], self.index.search(u"show 1080p", 10, max_ranked=2)[1]),
+                         map(lambda index: _to_ms(self.timestamp - timedelta(hours=index)), xrange(2)))
+
+    def test_ranking_order(self):
+        # Name matches outrank file path matches, newer torrents outrank older ones
+        self.add(u"other", [u"ubuntu/readme.txt"])
+        self.add(u"Ubuntu 16.04 desktop")
+        self.add(u"Ubuntu 14.04 desktop", timestamp=self.timestamp - timedelta(days=1))
+        self.update()
+
+        count, results = search_all(self.index, u"ubuntu", 10)
+        self.assertEqual((count, results), (3, [u"Ubuntu 16.04 desktop", u"Ubuntu 14.04 desktop", u"other"]))
+
+        self.assertEqual(search_all(self.index, u"ubuntu desktop", 10)[1],
+                         [u"Ubuntu 16.04 desktop", u"Ubuntu 14.04 desktop"])
+        self.assertEqual(search_all(self.index, u"ubuntu missing", 10), (0, []))
+
+    def test_paging(self):
+        names = [u"show {0}".format(index) for index in xrange(7)]
+        for index, name in enumerate(names):
+            self.add(name, timestamp=self.timestamp - timedelta(hours=index))
+        self.update()
+
+        count, results = search_all(self.index, u"show", 3)
+        self.assertEqual((count, results), (7, names))
+
+        _, page, _, tokens = db_search_torrents(self.db, u"show", ["name"], limit=3, search_backend=self.index)
+        _, page, _, tokens = db_search_torrents(self.db, u"show", ["name"], limit=3, token=tokens["next"],
+                                                search_backend=self.index)
+        _, page, _, _ = db_search_torrents(self.db, u"show", ["name"], limit=3, token=tokens["previous"],
+                                           search_backend=self.index)
+        self.assertEqual(map(lambda item: item["name"], page), names[:3])
+
+
+if __name__ == "__main__":
+    unittest.main()
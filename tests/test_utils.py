@@ -0,0 +1,28 @@
+import unittest
+
+from web.utils import get_files_summary
+
+
+class FilesSummaryTest(unittest.TestCase):
+    def test_summary(self):
+        summary = get_files_summary([{"path": [u"dir", u"movie.avi"], "length": 10},
+                                     {"path": [u"readme.txt"], "length": 5}], preview_size=1)
+
+        self.assertEqual(summary, {"total_size": 15, "files_count": 2,
+                                   "preview_files": [{"name": u"dir/movie.avi", "length": 10,
+                                                      "icon": "fa-file-video-o"}]})
+
+    def test_malformed_files(self):
+        summary = get_files_summary([{"path": [], "length": 10},
+                                     {"path": [u"a.txt", 1], "length": u"5"},
+                                     {"length": -1},
+                                     None])
+
+        self.assertEqual(summary["total_size"], 10)
+        self.assertEqual(summary["files_count"], 4)
+        self.assertEqual(map(lambda f: (f["name"], f["length"]), summary["preview_files"]),
+                         [(u"", 10), (u"a.txt", 0), (u"", 0), (u"", 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of DHT routing table bucket lookup ("RoutingTable.getBucketFor") and closest nodes lookup
+("RoutingTable.findNeighbors"), compares them with linear scans of buckets and checks, that results are the same.
+
+Usage: python tools/benchmark_routing_table.py [nodes_per_prefix] [lookups_count]
+"""
+import heapq
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from service.dht.server.node import Node
+from service.dht.server.routing import RoutingTable
+
+
+class IdleProtocol(object):
+    # Full buckets ping their head node, benchmark has no network
+    def callPing(self, node):
+        pass
+
+
+def linear_bucket_for(table, node):
+    for index, bucket in enumerate(table.buckets):
+        if node.long_id <= bucket.range[1]:
+            return index
+
+
+def linear_find_neighbors(table, node, k=None):
+    nodes = [(node.distanceTo(neighbor), neighbor)
+             for bucket in table.buckets for neighbor in bucket.getNodes() if neighbor.id != node.id]
+    return map(lambda item: item[1], heapq.nsmallest(k or table.ksize, nodes))
+
+
+def random_node(local_node, prefix_length):
+    # Random node sharing exactly "prefix_length" leading bits with local node
+    distance = random.getrandbits(160) >> (prefix_length + 1) | 1 << (159 - prefix_length)
+    return Node(("%040x" % (local_node.long_id ^ distance)).decode("hex"), "127.0.0.1", 6881)
+
+
+def fill_table(nodes_per_prefix):
+    # Like in real network, table holds nodes at any distance and splits down to ~160 buckets
+    local_node = Node(os.urandom(20))
+    table = RoutingTable(IdleProtocol(), 8, local_node)
+
+    for prefix_length in xrange(160):
+        for _ in xrange(nodes_per_prefix):
+            table.addContact(random_node(local_node, prefix_length))
+
+    return table
+
+
+def main(nodes_per_prefix=16, lookups_count=100000):
+    table = fill_table(nodes_per_prefix)
+    nodes = [random_node(table.node, random.randrange(160)) for _ in xrange(lookups_count)]
+
+    # Lookup targets (info_hashes) are mostly far from local node
+    targets = [Node(os.urandom(20)) for _ in xrange(lookups_count // 200)] + nodes[:lookups_count // 200]
+
+    for node in nodes[:1000]:
+        index = table.getBucketFor(node)
+        assert index == linear_bucket_for(table, node) and table.buckets[index].hasInRange(node)
+
+    for node in targets:
+        assert table.findNeighbors(node) == linear_find_neighbors(table, node)
+
+    print "Buckets: {0}, nodes: {1}".format(len(table.buckets), sum(map(len, table.buckets)))
+
+    for name, lookup, items in (
+            ("getBucketFor bisect", table.getBucketFor, nodes),
+            ("getBucketFor linear", lambda node: linear_bucket_for(table, node), nodes),
+            ("findNeighbors", table.findNeighbors, targets),
+            ("findNeighbors linear", lambda node: linear_find_neighbors(table, node), targets)):
+        elapsed = min(timeit.repeat(lambda: map(lookup, items), number=1, repeat=3))
+        print "{0}: {1:.3f} us per lookup".format(name, elapsed * 1e6 / len(items))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
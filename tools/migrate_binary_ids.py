@@ -0,0 +1,73 @@
+"""
+Convert info_hashes and node ids stored as 40 hex chars into 20 bytes binary values
+("hashes", "torrents", "torrent_files" and "crawler_route" collections).
+Stop crawlers, indexers and servers before migration, start them with "BINARY_IDS = True"
+(see "api_server_config.py" and "web_server_config.py").
+
+Usage: python tools/migrate_binary_ids.py [mongodb_uri]
+"""
+import sys
+from binascii import unhexlify
+
+from bson import Binary
+from pymongo import MongoClient, UpdateOne
+
+
+def to_binary(value):
+    # Binary is "str" subclass in python 2
+    return Binary(unhexlify(value)) if isinstance(value, basestring) and not isinstance(value, Binary) else value
+
+
+def migrate_collection(collection, field, batch_size=1000):
+    cursor = collection.find(filter={field: {"$type": "string"}},
+                             projection={"_id": True, field: True})
+
+    operations, updated_count = [], 0
+
+    for doc in cursor:
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: to_binary(doc[field])}}))
+
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            updated_count += len(operations)
+            operations = []
+
+            print "{0}: {1} documents updated".format(collection.name, updated_count)
+
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        updated_count += len(operations)
+
+    print "{0}: done, {1} documents updated".format(collection.name, updated_count)
+
+
+def migrate_routing_tables(collection):
+    for doc in collection.find():
+        buckets = map(lambda bucket: map(lambda node: [to_binary(node[0])] + list(node[1:]), bucket),
+                      doc.get("buckets", []))
+
+        collection.update_one({"_id": doc["_id"]},
+                              {"$set": {"local_node_id": to_binary(doc["local_node_id"]),
+                                        "buckets": buckets}})
+
+    print "{0}: done".format(collection.name)
+
+
+def migrate(mongodb_uri):
+    mongo_client = MongoClient(mongodb_uri)
+    try:
+        db = mongo_client.grapefruit
+
+        for collection in (db.hashes, db.torrents, db.torrent_files):
+            migrate_collection(collection, "info_hash")
+
+        migrate_routing_tables(db.crawler_route)
+
+        # Cached results and pages contain hex values
+        db.result_cache.delete_many({})
+    finally:
+        mongo_client.close()
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else "mongodb://localhost:27017/grapefruit")
@@ -0,0 +1,47 @@
+"""
+Backfill precomputed display aggregates ("total_size", "files_count", "preview_files") of torrents,
+stored before they were computed at ingest time.
+
+Usage: python tools/migrate_display_fields.py [mongodb_uri]
+"""
+import os
+import sys
+
+from pymongo import MongoClient, UpdateOne
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "web"))
+
+from utils import get_files_summary
+
+
+def migrate(mongodb_uri, batch_size=1000):
+    mongo_client = MongoClient(mongodb_uri)
+    try:
+        torrents = mongo_client.grapefruit.torrents
+
+        cursor = torrents.find(filter={"files": {"$exists": True}, "files_count": {"$exists": False}},
+                               projection={"_id": True, "files": True})
+
+        operations, updated_count = [], 0
+
+        for doc in cursor:
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": get_files_summary(doc["files"])}))
+
+            if len(operations) >= batch_size:
+                torrents.bulk_write(operations, ordered=False)
+                updated_count += len(operations)
+                operations = []
+
+                print "{0} torrents updated".format(updated_count)
+
+        if operations:
+            torrents.bulk_write(operations, ordered=False)
+            updated_count += len(operations)
+
+        print "Done, {0} torrents updated".format(updated_count)
+    finally:
+        mongo_client.close()
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else "mongodb://localhost:27017/grapefruit")
@@ -0,0 +1,75 @@
+"""
+Move large files lists of torrents, stored before "torrent_files" collection was introduced, into chunks
+(see "_store_files_chunks" in "web/api.py"), only first "FILES_INLINE_MAX" files are kept in torrent document.
+Migration can be run while services are running and restarted after failure.
+
+Usage: python tools/migrate_files_chunks.py [mongodb_uri]
+"""
+import os
+import sys
+import json
+import zlib
+
+from bson import Binary
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "web"))
+
+from api import FILES_INLINE_MAX, FILES_CHUNK_SIZE, FILES_CHUNKS_COMPRESSION
+from utils import get_files_summary
+
+
+def chunks_operations(info_hash, files, compress=FILES_CHUNKS_COMPRESSION):
+    # Info_hash is kept as stored (hex or binary)
+    for index, start in enumerate(xrange(0, len(files), FILES_CHUNK_SIZE)):
+        chunk = files[start: start + FILES_CHUNK_SIZE]
+
+        yield ReplaceOne({"info_hash": info_hash, "index": index},
+                         {"info_hash": info_hash,
+                          "index": index,
+                          "compressed": compress,
+                          "files": Binary(zlib.compress(json.dumps(chunk))) if compress else chunk},
+                         upsert=True)
+
+
+def migrate(mongodb_uri, batch_size=100):
+    mongo_client = MongoClient(mongodb_uri)
+    try:
+        db = mongo_client.grapefruit
+
+        cursor = db.torrents.find(filter={"files_chunks": {"$exists": False},
+                                          "files.{0}".format(FILES_INLINE_MAX): {"$exists": True}},
+                                  projection={"_id": True, "info_hash": True, "files": True})
+
+        operations, updated_count = [], 0
+
+        for doc in cursor:
+            files = doc["files"]
+            chunks = list(chunks_operations(doc["info_hash"], files))
+
+            # Chunks are written before torrent document is truncated
+            db.torrent_files.bulk_write(chunks, ordered=False)
+
+            operations.append(UpdateOne({"_id": doc["_id"], "files_chunks": {"$exists": False}},
+                                        {"$set": dict(get_files_summary(files),
+                                                      files=files[:FILES_INLINE_MAX],
+                                                      files_chunks=len(chunks))}))
+
+            if len(operations) >= batch_size:
+                db.torrents.bulk_write(operations, ordered=False)
+                updated_count += len(operations)
+                operations = []
+
+                print "{0} torrents updated".format(updated_count)
+
+        if operations:
+            db.torrents.bulk_write(operations, ordered=False)
+            updated_count += len(operations)
+
+        print "Done, {0} torrents updated".format(updated_count)
+    finally:
+        mongo_client.close()
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else "mongodb://localhost:27017/grapefruit")
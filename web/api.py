@@ -1,135 +1,690 @@
+import re
+import json
+import zlib
 from time import time
+from binascii import hexlify, unhexlify
+from math import log
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
 
-from pymongo import DESCENDING
+from bson import Binary, ObjectId, SON
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
 
+from cache import TTLCache
+from utils import get_files_summary
 
-def db_search_torrents(db, query, fields, offset=0, limit=0):
-    assert isinstance(fields, list)
+# Default weights of info_hash loading score, see "_loading_score"
+LOADING_SCORE_WEIGHTS = {"popularity": 1.0, "recency": 1.0, "failures": 1.0}
+
+# Text search matches are not counted beyond this number
+SEARCH_MAX_COUNT = 1000
+
+# Info_hashes and node ids are stored as 20 bytes binary values (40 hex chars in api), set by servers
+# from "BINARY_IDS" config option, existing databases must be converted by "tools/migrate_binary_ids.py"
+BINARY_IDS = False
+
+# Files lists longer than "FILES_INLINE_MAX" are stored in "torrent_files" collection by chunks
+FILES_INLINE_MAX = 100
+FILES_CHUNK_SIZE = 1000
+FILES_CHUNKS_COMPRESSION = True
+
+# Page token directions
+PAGE_NEXT = "next"
+PAGE_PREVIOUS = "previous"
+
+_EPOCH = datetime(1970, 1, 1)
+
+_ID_RE = re.compile(r"^[0-9a-fA-F]{40}$")
+
+
+def is_info_hash(value):
+    return isinstance(value, basestring) and _ID_RE.match(value) is not None
+
+
+def _id_to_db(value):
+    """
+    :param value: info_hash or node id in hex
+    :raise ValueError: on malformed value
+    """
+    if not is_info_hash(value):
+        raise ValueError("Invalid info_hash")
+
+    return Binary(unhexlify(value)) if BINARY_IDS else value.lower()
+
+
+def _id_from_db(value):
+    # Hex for api, values stored before "tools/migrate_binary_ids.py" are hex already
+    return hexlify(value) if isinstance(value, Binary) else value
+
+
+def _ids_from_db(items, field="info_hash"):
+    for item in items:
+        if field in item:
+            item[field] = _id_from_db(item[field])
+
+    return items
+
+_search_count_cache = TTLCache(ttl=5 * 60)  # (query, max_count) -> matches count
+
+
+def _normalize_query(query):
+    # Text search is case insensitive and ignores extra whitespaces
+    return u" ".join(query.lower().split())
+
+
+def _encode_token_value(value):
+    if isinstance(value, datetime):
+        # Milliseconds since epoch, mongodb dates precision
+        delta = value - _EPOCH
+        return delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds // 1000
+    elif isinstance(value, ObjectId):
+        return str(value)
+    else:
+        return value
+
+
+def _decode_token_value(value_type, value):
+    if value is None:
+        return None
+    elif value_type is datetime:
+        return _EPOCH + timedelta(milliseconds=value)
+    else:
+        return value_type(value)
+
+
+def _encode_token(direction, key):
+    return urlsafe_b64encode(json.dumps([direction] + map(_encode_token_value, key)))
 
-    projection = {"score": {"$meta": "textScore"}, "_id": False}
 
-    for field in fields:
-        projection[field] = True
+def _decode_token(token, key_types):
+    """
+    :raise ValueError: on malformed token
+    """
+    try:
+        items = json.loads(urlsafe_b64decode(str(token)))
+        direction, values = items[0], items[1:]
+
+        assert direction in (PAGE_NEXT, PAGE_PREVIOUS) and len(values) == len(key_types)
+
+        return direction, map(lambda (value_type, value): _decode_token_value(value_type, value),
+                              zip(key_types, values))
+    except Exception:
+        raise ValueError("Invalid page token")
+
+
+def _keyset_query(key_fields, token, key_types):
+    # Filter and sort order of page following (preceding) token key
+    direction, key = _decode_token(token, key_types) if token else (PAGE_NEXT, None)
+    order = DESCENDING if direction == PAGE_NEXT else ASCENDING
+    op = "$lt" if direction == PAGE_NEXT else "$gt"
+
+    if key:
+        # (f1 < v1) or (f1 == v1 and f2 < v2) or ...
+        query_filter = {"$or": [dict(zip(key_fields[:i], key[:i]), **{key_fields[i]: {op: key[i]}})
+                                for i in xrange(len(key_fields))]}
+    else:
+        query_filter = {}
+
+    return direction, bool(key), query_filter, map(lambda field: (field, order), key_fields)
+
+
+def _keyset_page(items, limit, key_fields, direction, has_token):
+    """
+    :param items: up to "limit" + 1 items in query order
+    :return: (page items in descending order, tokens of next and previous pages)
+    """
+    has_more = limit and len(items) > limit
+    items = items[:limit] if limit else items
+
+    if direction == PAGE_PREVIOUS:
+        items.reverse()
+
+    has_next = has_more if direction == PAGE_NEXT else has_token
+    has_previous = has_token if direction == PAGE_NEXT else has_more
+
+    def make_token(page_direction, item):
+        return _encode_token(page_direction, map(lambda field: item.get(field, None), key_fields))
+
+    return items, {"next": make_token(PAGE_NEXT, items[-1]) if items and has_next else None,
+                   "previous": make_token(PAGE_PREVIOUS, items[0]) if items and has_previous else None}
+
+
+def _backend_search_page(db, search_backend, query, fields, limit, direction, key, max_count=None):
+    # Page of built-in index search results, documents are fetched by ids in index ranking order
+    if key:
+        score, timestamp, oid = key
+        key = (score, _encode_token_value(timestamp), oid.binary)
+
+    results_count, ranked = search_backend.search(query, limit + 1 if limit else SEARCH_MAX_COUNT, key,
+                                                  after=direction == PAGE_NEXT, max_count=max_count)
+
+    ids = map(lambda (score, timestamp, oid): ObjectId(oid), ranked)
+    projection = dict.fromkeys(fields + ["timestamp"], True)
+    docs = {doc["_id"]: doc for doc in db.torrents.find(filter={"_id": {"$in": ids}}, projection=projection)}
+
+    results = []
+    for (score, timestamp, oid), _id in zip(ranked, ids):
+        if _id in docs:
+            docs[_id]["score"] = score
+            results.append(docs[_id])
+
+    if direction == PAGE_PREVIOUS:
+        # Query order, "_keyset_page" reverses it back
+        results.reverse()
+
+    return results_count, results
+
+
+def db_search_torrents(db, query, fields, limit=0, token=None, max_count=None, cache=None, search_backend=None):
+    """
+    Search results are ordered by text score and timestamp, pages are addressed by opaque tokens.
+
+    :param token: "next" or "previous" page token from previous results, first page if omitted
+    :param max_count: stop counting matches after "max_count", count is "max_count" + 1 then ("1000+")
+    :param cache: results cache (see "cache.py"), search pages are not invalidated when torrents are added
+                  (any added torrent can change any page), so cached page can miss new torrents for up to cache ttl
+    :param search_backend: built-in index (see "search_index.py"), mongodb fulltext index is used if omitted
+    :return: (matches count, results, elapsed time, {"next": token, "previous": token}),
+             matches count is cached for 5 minutes, so it can lag behind results for that long
+    :raise ValueError: on malformed token
+    """
+    assert isinstance(fields, list)
 
     start_time = time()
 
-    cursor = db.torrents.find(
-        filter={"$text": {"$search": query}},
-        projection=projection,
-        sort=[("score", {"$meta": "textScore"}), ("timestamp", DESCENDING)]
-    )
+    cache_key = ("search", _normalize_query(query), tuple(sorted(fields)), limit, token, max_count)
+    cached = cache.get(cache_key) if cache else None
 
-    if cursor:
-        results_count, results = cursor.count(), list(cursor.skip(offset).limit(limit))
+    if cached:
+        results_count, results, tokens = cached
+        return results_count, results, time() - start_time, tokens
+
+    key_fields = ["score", "timestamp", "_id"]
+    direction, has_token, page_filter, sort = _keyset_query(key_fields, token, [float, datetime, ObjectId])
+
+    if search_backend and not is_info_hash(query.strip()):
+        # Built-in index counts matches (up to "max_count") on each query
+        key = _decode_token(token, [float, datetime, ObjectId])[1] if has_token else None
+        backend_count, items = _backend_search_page(db, search_backend, query, fields, limit, direction, key,
+                                                    max_count)
     else:
-        results_count, results = 0, []
+        backend_count = None
+
+        if is_info_hash(query.strip()):
+            # Binary info_hash is not covered by fulltext index
+            projection = {"score": {"$literal": 0.0}, "timestamp": True}
+            query_filter = {"info_hash": _id_to_db(query.strip())}
+        else:
+            projection = {"score": {"$meta": "textScore"}, "timestamp": True}
+            query_filter = {"$text": {"$search": query}}
+
+        for field in fields:
+            projection[field] = True
+
+        # Text score can't be filtered by "find", so it is projected into field by aggregation.
+        # Score is known after "$text" stage only, so all matches are still scored and sorted on each page,
+        # keyset saves skipping of previous pages, but deep search pages are not cheaper than first one
+        pipeline = [{"$match": query_filter},
+                    {"$project": projection}]
+
+        if page_filter:
+            pipeline.append({"$match": page_filter})
+
+        pipeline.append({"$sort": SON(sort)})
+
+        if limit:
+            pipeline.append({"$limit": limit + 1})
+
+        items = list(db.torrents.aggregate(pipeline))
+
+    results, tokens = _keyset_page(_ids_from_db(items), limit, key_fields, direction, has_token)
+
+    for item in results:
+        item.pop("_id")
+
+        if "timestamp" not in fields:
+            item.pop("timestamp", None)
+
+    if backend_count is not None:
+        results_count = min(backend_count, max_count + 1) if max_count else backend_count
+    elif not has_token and not tokens["next"]:
+        # All matches are fetched already
+        results_count = len(results)
+    else:
+        count_key = (_normalize_query(query), max_count)
+        results_count = _search_count_cache.get(count_key, None)
+
+        if results_count is None:
+            if max_count:
+                results_count = db.torrents.count(filter=query_filter, limit=max_count + 1)
+            else:
+                results_count = db.torrents.count(filter=query_filter)
+
+            _search_count_cache.set(count_key, results_count)
+
+    if cache:
+        cache.set(cache_key, (results_count, results, tokens))
 
     elapsed_time = time() - start_time
 
-    return results_count, results, elapsed_time
+    return results_count, results, elapsed_time, tokens
+
+
+def _iter_files_chunks(db, info_hash, first_index, last_index=None):
+    index_filter = {"$gte": first_index}
+    if last_index is not None:
+        index_filter["$lte"] = last_index
+
+    for chunk in db.torrent_files.find(filter={"info_hash": _id_to_db(info_hash), "index": index_filter},
+                                       projection={"_id": False, "files": True, "compressed": True},
+                                       sort=[("index", ASCENDING)]):
+        if chunk.get("compressed", False):
+            yield json.loads(zlib.decompress(chunk["files"]))
+        else:
+            yield chunk["files"]
+
+
+def db_iter_torrent_files(db, torrent, offset=0, limit=None):
+    """
+    Stream files of torrent document, large files lists are read from "torrent_files" chunks.
+
+    :param torrent: torrent document with "files" and "files_chunks" fields
+    """
+    if not torrent.get("files_chunks", 0):
+        for f in torrent.get("files", [])[offset: offset + limit if limit is not None else None]:
+            yield f
+    else:
+        first_index = offset // FILES_CHUNK_SIZE
+        last_index = (offset + limit - 1) // FILES_CHUNK_SIZE if limit else None
+        skip = offset - first_index * FILES_CHUNK_SIZE
+
+        for files in _iter_files_chunks(db, torrent["info_hash"], first_index, last_index):
+            for f in files[skip:]:
+                if limit is not None:
+                    if limit <= 0:
+                        return
 
+                    limit -= 1
 
-def db_get_torrent_details(db, info_hash):
+                yield f
+
+            skip = 0
+
+
+def db_get_torrent_details(db, info_hash, cache=None, files_offset=0, files_limit=None):
+    """
+    :param cache: results cache (see "cache.py"), entry is invalidated when metadata is stored
+    :param files_offset: first file of returned "files" page
+    :param files_limit: files count of returned "files" page, all files if omitted
+    :return: (torrent with "files" page and "files_count", elapsed time)
+    """
     start_time = time()
 
-    # Query database
-    result = db.torrents.find_one(
-        filter={"info_hash": info_hash},
-        projection={
-            "_id": False,
-            "name": True,
-            "files": True,
-            "info_hash": True
-        }
-    )
+    cache_key = ("details", info_hash)
+    cached = cache.get(cache_key) if cache else None
+
+    if cached:
+        # Missed torrents are cached too
+        result = cached[0]
+    else:
+        # Query database
+        result = db.torrents.find_one(
+            filter={"info_hash": _id_to_db(info_hash)},
+            projection={
+                "_id": False,
+                "name": True,
+                "files": True,
+                "files_chunks": True,
+                "files_count": True,
+                "total_size": True,
+                "info_hash": True
+            }
+        )
+
+        if result:
+            result["info_hash"] = _id_from_db(result["info_hash"])
+
+        if cache:
+            cache.set(cache_key, [result])
+
+    if result:
+        # Cached document is shared
+        result = dict(result)
+        result["files_count"] = result.get("files_count", len(result.get("files", [])))
+        result["files"] = list(db_iter_torrent_files(db, result, files_offset, files_limit))
+        result.pop("files_chunks", None)
 
     elapsed_time = time() - start_time
 
     return result, elapsed_time
 
 
-def db_get_last_torrents(db, fields, offset=0, limit=100):
+def db_get_last_torrents(db, fields, limit=100, token=None):
+    """
+    Torrents ordered by timestamp (newest first), pages are addressed by opaque tokens.
+
+    :param token: "next" or "previous" page token from previous results, first page if omitted
+    :return: (torrents count, results, elapsed time, {"next": token, "previous": token})
+    :raise ValueError: on malformed token
+    """
     assert isinstance(fields, list)
 
-    projection = {"_id": False}
+    key_fields = ["timestamp", "_id"]
+    direction, has_token, page_filter, sort = _keyset_query(key_fields, token, [datetime, ObjectId])
+
+    projection = {"timestamp": True}
     projection.update({field: True for field in fields})
 
     start_time = time()
 
-    # Query database
+    # Query database, "timestamp_id" index scan
     cursor = db.torrents.find(
-        filter={},
+        filter=page_filter,
         projection=projection,
-        sort=[("timestamp", DESCENDING)]
+        sort=sort,
+        limit=limit + 1 if limit else 0
     )
 
-    if cursor:
-        results_count, results = min(cursor.count(), 100), list(cursor.skip(offset).limit(limit))
-    else:
-        results_count, results = 0, []
+    results, tokens = _keyset_page(_ids_from_db(list(cursor)), limit, key_fields, direction, has_token)
+
+    for item in results:
+        item.pop("_id")
+
+        if "timestamp" not in fields:
+            item.pop("timestamp", None)
+
+    results_count = db_get_torrents_count(db)
 
     elapsed_time = time() - start_time
 
-    return results_count, results, elapsed_time
+    return results_count, results, elapsed_time, tokens
+
+
+def _get_counter(db, name):
+    # Documents count, maintained incrementally in "counters" collection
+    counter = db.counters.find_one({"_id": name})
+    return counter["count"] if counter else db[name].count()
+
+
+def _inc_counters(db, **counters):
+    operations = [UpdateOne({"_id": name}, {"$inc": {"count": value}}, upsert=True)
+                  for name, value in counters.items() if value]
+
+    if operations:
+        db.counters.bulk_write(operations, ordered=False)
 
 
 def db_get_torrents_count(db):
-    return db.torrents.count()
+    return _get_counter(db, "torrents")
 
 
 def db_get_hashes_count(db):
-    return db.hashes.count()
+    return _get_counter(db, "hashes")
 
 
 def db_torrent_exists(db, info_hash, has_metadata=False):
     coll = db.torrents if has_metadata else db.hashes
-    return coll.count(filter={"info_hash": info_hash}) > 0
+    return coll.count(filter={"info_hash": _id_to_db(info_hash)}) > 0
+
+
+def db_insert_or_update_torrent(db, info_hash, timestamp, metadata=None, cache=None):
+    return db_insert_or_update_torrents(db, [(info_hash, metadata)], timestamp, cache) > 0
+
+
+def _metadata_matches(info_hash, metadata):
+    return not metadata or str(metadata.get("info_hash", info_hash)).lower() == info_hash.lower()
+
+
+def _bulk_upserted_keys(collection, operations, keys):
+    # Unordered bulk upsert, return keys of inserted documents
+    if not operations:
+        return set()
+
+    try:
+        result = collection.bulk_write(operations, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        # Concurrent upserts of the same key are rejected by unique index, document exists anyway,
+        # any other write error is real failure
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+        result = e.details
+
+    return set(keys[item["index"]] for item in result["upserted"])
+
+
+def _store_files_chunks(db, info_hash, metadata, compress=FILES_CHUNKS_COMPRESSION):
+    """
+    Move large files list into "torrent_files" collection, chunks are written before torrent document,
+    so stored torrent never misses them. Existing chunks are kept, chunks of concurrent stores are the same.
 
+    :return: metadata to store in "torrents" collection, only first "FILES_INLINE_MAX" files are kept
+             inline (for fulltext index), "files_chunks" is a count of chunks in "torrent_files"
+    """
+    files = metadata.get("files", [])
+    if len(files) <= FILES_INLINE_MAX:
+        return metadata
+
+    operations = []
+    for index, start in enumerate(xrange(0, len(files), FILES_CHUNK_SIZE)):
+        chunk = files[start: start + FILES_CHUNK_SIZE]
+
+        operations.append(UpdateOne(
+            {"info_hash": _id_to_db(info_hash), "index": index},
+            {"$setOnInsert": {"info_hash": _id_to_db(info_hash),
+                              "index": index,
+                              "compressed": compress,
+                              "files": Binary(zlib.compress(json.dumps(chunk))) if compress else chunk}},
+            upsert=True))
+
+    _bulk_upserted_keys(db.torrent_files, operations, range(len(operations)))
+
+    return dict(metadata, files=files[:FILES_INLINE_MAX], files_chunks=len(operations))
 
-def db_insert_or_update_torrent(db, db_lock, info_hash, timestamp, metadata=None):
-    with db_lock:
-        result = False
-
-        if not db_torrent_exists(db, info_hash, False):
-            db.hashes.insert_one({"info_hash": info_hash,
-                                  "access_count": 0,
-                                  "loaded": bool(metadata)})
-            result = True
-
-        if metadata and not db_torrent_exists(db, info_hash, True):
-            db.torrents.insert_one(dict({"info_hash": info_hash,
-                                         "timestamp": timestamp},
-                                        **metadata))
-            db.hashes.update({"info_hash": info_hash},
-                             {"$set": {"loaded": True}})
-            result = True
 
-        return result
+def db_insert_or_update_torrents(db, torrents, timestamp, cache=None):
+    """
+    Idempotent bulk upsert of info_hashes and metadata, safe for concurrent callers without locking.
 
+    :param torrents: list of (info_hash, metadata or None) tuples
+    :param cache: results cache, details of stored torrents are invalidated
+    :return: count of info_hashes, which are inserted or got metadata
+    """
+    # Metadata of other info_hash (see "api_add_torrent") isn't stored, info_hash is stored without it
+    torrents = map(lambda (info_hash, metadata): (info_hash, metadata if _metadata_matches(info_hash, metadata)
+                                                  else None),
+                   dict(torrents).items())
 
-def db_increase_access_count(db, db_lock, info_hashes):
-    with db_lock:
-        for info_hash in info_hashes:
-            db.hashes.update(
-                {"info_hash": info_hash},
-                {"$inc": {"access_count": 1}}
-            )
+    hashes = map(lambda item: item[0], torrents)
+    new_hashes = _bulk_upserted_keys(
+        db.hashes,
+        map(lambda (info_hash, metadata): UpdateOne(
+            {"info_hash": _id_to_db(info_hash)},
+            {"$setOnInsert": {"info_hash": _id_to_db(info_hash),
+                              "access_count": 0,
+                              "loaded": bool(metadata),
+                              "next_attempt_at": timestamp,
+                              "ready": True}},
+            upsert=True), torrents),
+        hashes)
 
+    # Metadata of stored torrents is never changed, so files chunks are prepared for new torrents only
+    loaded = filter(lambda item: item[1], torrents)
+    stored = set(map(lambda doc: _id_from_db(doc["info_hash"]).lower(),
+                     db.torrents.find(filter={"info_hash": {"$in": map(lambda item: _id_to_db(item[0]), loaded)}},
+                                      projection={"_id": False, "info_hash": True}))) if loaded else set()
+    loaded = filter(lambda item: item[0].lower() not in stored, loaded)
 
-def db_fetch_not_indexed_torrents(db, size=10, max_access_count=3):
-    def make_query(is_lt):
-        return [
-            {"$match": {
-                "loaded": False,
-                "access_count": {"$lt" if is_lt else "$gte": max_access_count}}},
-            {"$sample": {"size": size}}
-        ]
+    new_torrents = _bulk_upserted_keys(
+        db.torrents,
+        map(lambda (info_hash, metadata): UpdateOne(
+            {"info_hash": _id_to_db(info_hash)},
+            {"$setOnInsert": dict(_store_files_chunks(db, info_hash, metadata),
+                                  info_hash=_id_to_db(info_hash),
+                                  timestamp=timestamp,
+                                  **get_files_summary(metadata.get("files", [])))},
+            upsert=True), loaded),
+        map(lambda item: item[0], loaded))
 
-    def select(query):
-        return map(lambda item: item["info_hash"], db.hashes.aggregate(query))
+    if new_torrents:
+        db.hashes.update_many({"info_hash": {"$in": map(_id_to_db, new_torrents)}},
+                              {"$set": {"loaded": True},
+                               "$unset": {"peers": ""}})
+
+    _inc_counters(db, hashes=len(new_hashes), torrents=len(new_torrents))
+
+    if cache:
+        for info_hash in new_torrents:
+            cache.delete(("details", info_hash))
+
+    return len(new_hashes | new_torrents)
+
+
+def db_insert_torrents(db, info_hashes, timestamp, peers=None, max_peers=16, sightings=None):
+    """
+    :param sightings: dict of info_hash -> sightings count, each info_hash counts as seen once by default,
+                      sightings of other (already stored) info_hashes are counted without inserting
+    """
+    inserted_count = db_insert_or_update_torrents(db, map(lambda info_hash: (info_hash, None), info_hashes),
+                                                  timestamp)
+
+    counts = dict.fromkeys(info_hashes, 1)
+    counts.update(sightings or {})
+
+    db_add_sightings(db, counts, timestamp, peers, max_peers)
+
+    return inserted_count
+
+
+def db_add_sightings(db, sightings, timestamp, peers=None, max_peers=16):
+    """
+    Bump sightings counter and last sighting time of not loaded info_hashes in bulk.
+
+    :param sightings: dict of info_hash -> sightings count
+    :param peers: dict of info_hash -> list of announced (host, port)
+    :param max_peers: only last "max_peers" announces are kept per info_hash
+    """
+    peers = peers or {}
+
+    def make_update(info_hash, count):
+        update = {"$inc": {"sightings": count},
+                  "$max": {"last_seen": timestamp}}
+
+        if peers.get(info_hash, None):
+            update["$push"] = {"peers": {
+                "$each": map(lambda peer: {"host": peer[0],
+                                           "port": peer[1],
+                                           "timestamp": timestamp}, peers[info_hash]),
+                "$slice": -max_peers}}
+
+        return update
+
+    operations = [UpdateOne({"info_hash": _id_to_db(info_hash), "loaded": False}, make_update(info_hash, count))
+                  for info_hash, count in dict(dict.fromkeys(peers, 0), **sightings).items()]
+
+    if operations:
+        db.hashes.bulk_write(operations, ordered=False)
+
+
+def db_get_announced_peers(item, timestamp, ttl):
+    # Unique announced peers younger than ttl (seconds)
+    return list(set(
+        (peer["host"], peer["port"]) for peer in item.get("peers", [])
+        if (timestamp - peer["timestamp"]).total_seconds() < ttl))
+
+
+def _retry_delay(access_count, retry_delay, max_retry_delay):
+    # Exponential backoff, doubles with every unsuccessful loading attempt
+    return timedelta(seconds=min(retry_delay * 2 ** max(access_count - 1, 0), max_retry_delay))
+
+
+def _loading_score(item, timestamp, weights):
+    # Sightings count in log scale, minus hours since last sighting in log scale, minus failed attempts
+    last_seen = item.get("last_seen", None) or datetime.utcfromtimestamp(0)
+    age = max((timestamp - last_seen).total_seconds() / 3600.0, 0)
+
+    return weights.get("popularity", 0) * log(1 + item.get("sightings", 0), 2) - \
+        weights.get("recency", 0) * log(1 + age, 2) - \
+        weights.get("failures", 0) * item.get("access_count", 0)
+
+
+def db_fetch_not_indexed_torrents(db, size=10, with_peers=False, peers_ttl=30 * 60, lease_timeout=10 * 60,
+                                  retry_delay=30 * 60, max_retry_delay=7 * 24 * 60 * 60, score_weights=None,
+                                  candidates_factor=4):
+    """
+    Claim up to "size" info_hashes with best loading score.
+
+    Candidates are taken from the queue heads (most sighted, recently sighted and longest waiting
+    info_hashes), ranked by "_loading_score" and best "size" of them are claimed by one update (concurrent
+    indexers never get the same info_hash) moving their "next_attempt_at" forward by "lease_timeout", so
+    under contention fewer than "size" info_hashes may be returned.
+    Claimed info_hashes are rescheduled with exponential backoff afterwards. Loaded info_hashes leave
+    the queue, not loaded ones return into it when the time comes.
+
+    Only "ready" info_hashes are in queue heads, claimed ones are not "ready" until their "next_attempt_at"
+    passes, so queue heads scans don't step over leased and backed off info_hashes, and each info_hash is
+    marked "ready" again once. Query cost doesn't grow with the number of waiting info_hashes.
 
-    result = select(make_query(True)) + select(make_query(False))
-    return result[:size]
+    :param lease_timeout: seconds, while claimed info_hash is invisible for other indexers
+    :param retry_delay: seconds before second attempt, next delays are doubled up to "max_retry_delay"
+    :param score_weights: dict with "popularity", "recency" and "failures" weights of loading score
+    :param candidates_factor: candidates count taken from each queue head is "size" * "candidates_factor"
+    :return: list of info_hashes, or list of {"info_hash": "hex", "peers": [...]} if "with_peers" is set
+    """
+    timestamp = datetime.utcnow()
+    lease_until = timestamp + timedelta(seconds=lease_timeout)
+    weights = dict(LOADING_SCORE_WEIGHTS, **(score_weights or {}))
+
+    score_projection = {"_id": False, "info_hash": True, "access_count": True,
+                        "sightings": True, "last_seen": True}
+    projection = dict(score_projection, peers=True) if with_peers else score_projection
+
+    # Return due info_hashes into queue
+    db.hashes.update_many({"loaded": False, "ready": False, "next_attempt_at": {"$lte": timestamp}},
+                          {"$set": {"ready": True}})
+
+    candidates = {}
+    for sort in ([("sightings", DESCENDING)], [("last_seen", DESCENDING)], [("next_attempt_at", ASCENDING)]):
+        for item in db.hashes.find(filter={"loaded": False, "ready": True},
+                                   projection=score_projection,
+                                   sort=[("loaded", ASCENDING), ("ready", ASCENDING)] + sort,
+                                   limit=size * candidates_factor):
+            candidates[_id_from_db(item["info_hash"])] = item
+
+    ranked = sorted(candidates.values(), key=lambda item: _loading_score(item, timestamp, weights), reverse=True)
+    ranked_hashes = map(lambda item: item["info_hash"], ranked[:size])
+
+    if not ranked_hashes:
+        return []
+
+    # One batched claim stamped with unique lease token, info_hashes claimed by other indexer first
+    # (their "next_attempt_at" is moved already) are skipped
+    lease_token = ObjectId()
+    db.hashes.update_many({"info_hash": {"$in": ranked_hashes}, "loaded": False, "ready": True},
+                          {"$set": {"next_attempt_at": lease_until, "lease_token": lease_token, "ready": False},
+                           "$inc": {"access_count": 1}})
+
+    rank = {info_hash: index for index, info_hash in enumerate(ranked_hashes)}
+    claimed = sorted(db.hashes.find(filter={"info_hash": {"$in": ranked_hashes}, "lease_token": lease_token},
+                                    projection=projection),
+                     key=lambda item: rank[item["info_hash"]])
+
+    # Lease holds for "lease_timeout" at least, unless info_hash was reclaimed already
+    operations = [UpdateOne({"info_hash": item["info_hash"], "lease_token": lease_token},
+                            {"$set": {"next_attempt_at": lease_until + _retry_delay(
+                                item["access_count"], retry_delay, max_retry_delay)}})
+                  for item in claimed]
+
+    if operations:
+        db.hashes.bulk_write(operations, ordered=False)
+
+    if with_peers:
+        return map(lambda item: {"info_hash": _id_from_db(item["info_hash"]),
+                                 "peers": db_get_announced_peers(item, timestamp, peers_ttl)},
+                   claimed)
+    else:
+        return map(lambda item: _id_from_db(item["info_hash"]), claimed)
 
 
 def db_load_routing_table(db, db_lock, local_node_host, local_node_port, local_node_id=None):
@@ -138,9 +693,9 @@ def db_load_routing_table(db, db_lock, local_node_host, local_node_port, local_n
                      {"local_node_port": local_node_port}]
 
         if local_node_id:
-            cond_list.append({"local_node_id": local_node_id})
+            cond_list.append({"local_node_id": _id_to_db(local_node_id)})
 
-        return db.crawler_route.find_one(
+        result = db.crawler_route.find_one(
             filter={"$and": cond_list},
             projection={"_id": False,
                         "local_node_host": True,
@@ -148,8 +703,22 @@ def db_load_routing_table(db, db_lock, local_node_host, local_node_port, local_n
                         "local_node_id": True,
                         "local_node_port": True})
 
+        if result:
+            result["local_node_id"] = _id_from_db(result["local_node_id"])
+            result["buckets"] = _map_buckets_ids(result.get("buckets", []), _id_from_db)
+
+        return result
+
+
+def _map_buckets_ids(buckets, convert):
+    # Buckets are lists of [node id, [host, port]]
+    return map(lambda bucket: map(lambda node: [convert(node[0])] + list(node[1:]), bucket), buckets)
+
 
 def db_store_routing_table(db, db_lock, buckets, node_id, node_host, node_port):
+    node_id = _id_to_db(node_id)
+    buckets = _map_buckets_ids(buckets, _id_to_db)
+
     with db_lock:
         if db.crawler_route.count({"local_node_id": node_id}) > 0:
             db.crawler_route.update({"local_node_id": node_id},
@@ -11,17 +11,26 @@ from flask import request
 from flask_pymongo import PyMongo
 
 from schema import deploy_schema
+from cache import make_result_cache
+from search_index import SearchIndex
 
+import api
 from api import *
 
 from datetime import datetime
 
+# Pages are addressed by "next_token" and "previous_token" of previous results, "offset=0" is still the first page
+OFFSET_ERROR = {"result": {"code": 400, "message": "\"offset\" argument is not supported, "
+                                                   "pass \"next_token\" or \"previous_token\" as \"token\""}}
 
-def start_api_server(mongodb_uri, host, port):
+
+def start_api_server(mongodb_uri, host, port, cache_ttl=60, cache_size=10000, shared_cache=False,
+                     search_index_path=None, search_index_writer=True, binary_ids=False):
     logging.basicConfig(filename=os.devnull,
                         level=logging.DEBUG)
 
-    deploy_schema(mongodb_uri)
+    deploy_schema(mongodb_uri, binary_ids)
+    api.BINARY_IDS = binary_ids
 
     app = Flask(__name__, static_url_path="")
     app.config["MONGO_URI"] = mongodb_uri
@@ -29,81 +38,155 @@ def start_api_server(mongodb_uri, host, port):
     mongo = PyMongo(app)
     db_lock = Lock()
 
+    with app.app_context():
+        result_cache = make_result_cache(mongo.db, cache_ttl, cache_size, shared_cache)
+
+        if search_index_path:
+            search_index = SearchIndex(search_index_path, writable=search_index_writer)
+            search_index.start(mongo.db)
+        else:
+            search_index = None
+
     @app.route("/api/search")
     def api_search():
         query = request.args.get("query")
-        offset = abs(int(request.args.get("offset", default=0)))
+        token = request.args.get("token", default=None, type=str)
         limit = min(abs(int(request.args.get("limit", default=100))), 100)
 
+        if abs(int(request.args.get("offset", default=0))):
+            return jsonify(OFFSET_ERROR)
+
         if query:
-            results_count, results, elapsed_time = db_search_torrents(
-                mongo.db,
-                query=query,
-                fields=["name", "info_hash"],
-                offset=offset,
-                limit=limit
-            )
-            return jsonify({"result": results, "count": results_count, "elapsed_time": elapsed_time})
+            try:
+                results_count, results, elapsed_time, tokens = db_search_torrents(
+                    mongo.db,
+                    query=query,
+                    fields=["name", "info_hash"],
+                    limit=limit,
+                    token=token,
+                    max_count=SEARCH_MAX_COUNT,
+                    cache=result_cache,
+                    search_backend=search_index
+                )
+            except ValueError:
+                return jsonify({"result": {"code": 500, "message": "invalid \"token\" argument"}})
+
+            return jsonify({"result": results, "count": min(results_count, SEARCH_MAX_COUNT),
+                            "count_is_approximate": results_count > SEARCH_MAX_COUNT,
+                            "next_token": tokens["next"], "previous_token": tokens["previous"],
+                            "elapsed_time": elapsed_time})
         else:
             return jsonify({"result": {"code": 404, "message": "empty \"query\" argument"}})
 
     @app.route("/api/latest")
     def api_latest():
-        offset = abs(int(request.args.get("offset", default=0)))
+        token = request.args.get("token", default=None, type=str)
         limit = min(abs(int(request.args.get("limit", default=100))), 100)
 
-        results_count, results, elapsed_time = db_get_last_torrents(
-            mongo.db,
-            fields=["name", "info_hash"],
-            offset=offset,
-            limit=limit
-        )
-        total_count = db_get_torrents_count(mongo.db)
+        if abs(int(request.args.get("offset", default=0))):
+            return jsonify(OFFSET_ERROR)
+
+        try:
+            results_count, results, elapsed_time, tokens = db_get_last_torrents(
+                mongo.db,
+                fields=["name", "info_hash"],
+                limit=limit,
+                token=token
+            )
+        except ValueError:
+            return jsonify({"result": {"code": 500, "message": "invalid \"token\" argument"}})
 
-        return jsonify({"result": results, "count": results_count, "total_count": total_count,
+        return jsonify({"result": results, "count": len(results), "total_count": results_count,
+                        "next_token": tokens["next"], "previous_token": tokens["previous"],
                         "elapsed_time": elapsed_time})
 
     @app.route("/api/details")
     def api_details():
         info_hash = request.args.get("info_hash", None)
-        if info_hash:
-            result, elapsed_time = db_get_torrent_details(mongo.db, info_hash)
+        files_offset = abs(request.args.get("files_offset", default=0, type=int))
+        files_limit = request.args.get("files_limit", default=None, type=int)
+
+        if is_info_hash(info_hash):
+            result, elapsed_time = db_get_torrent_details(mongo.db, info_hash, result_cache, files_offset,
+                                                          abs(files_limit) if files_limit is not None else None)
             return jsonify({"result": result, "elapsed_time": elapsed_time})
         else:
-            return jsonify({"result": {"code": 500, "message": "missed \"info_hash\" argument"}})
+            return jsonify({"result": {"code": 500, "message": "missed or invalid \"info_hash\" argument"}})
 
     @app.route("/api/add_torrent", methods=['POST'])
     def api_add_torrent():
         info_hash = request.form.get("info_hash", default=None, type=str)
         metadata = json.loads(request.form.get("metadata", default="{}", type=str), encoding="utf-8")
 
-        if info_hash:
+        if is_info_hash(info_hash):
             if metadata and metadata.get("info_hash", info_hash) != info_hash:
                 return jsonify({"result": {
                     "code": 500, "message": "invalid extra field \"info_hash\" in \"metadata\""
                 }})
 
-            if db_insert_or_update_torrent(mongo.db, db_lock, info_hash, datetime.utcnow(), metadata):
+            if db_insert_or_update_torrent(mongo.db, info_hash, datetime.utcnow(), metadata, result_cache):
                 return jsonify({"result": {"code": 202, "message": "accepted"}})
             else:
                 return jsonify({"result": {"code": 409, "message": "already exists"}})
         else:
-            return jsonify({"result": {"code": 500, "message": "missed \"info_hash\" argument"}})
+            return jsonify({"result": {"code": 500, "message": "missed or invalid \"info_hash\" argument"}})
+
+    @app.route("/api/add_torrents", methods=['POST'])
+    def api_add_torrents():
+        info_hashes = json.loads(request.form.get("info_hashes", default="[]", type=str))
+        peers = json.loads(request.form.get("peers", default="{}", type=str))
+        sightings = json.loads(request.form.get("sightings", default="{}", type=str))
+        metadata = json.loads(request.form.get("metadata", default="{}", type=str), encoding="utf-8")
+
+        # Crawlers post sightings of known info_hashes without info_hashes list
+        if isinstance(info_hashes, list) and (info_hashes or sightings and isinstance(sightings, dict)):
+            timestamp = datetime.utcnow()
+
+            # Malformed info_hashes are skipped
+            info_hashes = filter(is_info_hash, info_hashes)
+            peers = {info_hash: value for info_hash, value in peers.items()
+                     if is_info_hash(info_hash)} if isinstance(peers, dict) else None
+            sightings = {info_hash: count for info_hash, count in sightings.items()
+                         if is_info_hash(info_hash) and isinstance(count, int) and count > 0} \
+                if isinstance(sightings, dict) else None
+
+            if isinstance(metadata, dict) and metadata:
+                # Metadata documents for some of info_hashes (loaded by indexer)
+                inserted_count = db_insert_or_update_torrents(
+                    mongo.db,
+                    map(lambda info_hash: (info_hash, metadata.get(info_hash, None)
+                                           if isinstance(metadata.get(info_hash, None), dict) else None),
+                        set(info_hashes)),
+                    timestamp,
+                    result_cache)
+            else:
+                inserted_count = db_insert_torrents(mongo.db, list(set(info_hashes)), timestamp, peers,
+                                                    sightings=sightings)
+
+            return jsonify({"result": {"code": 202, "message": "accepted", "count": inserted_count}})
+        else:
+            return jsonify({"result": {"code": 500, "message": "missed \"info_hashes\" argument"}})
 
     @app.route("/api/fetch_torrents_for_load")
     def api_fetch_torrents_for_load():
         limit = request.args.get("limit", default=10, type=int)
-        max_access_count = request.args.get("max_access_count", default=3, type=int)
-        inc_access_count = request.args.get(
-            "inc_access_count", default="false", type=str).lower() == "true"
-
-        result = db_fetch_not_indexed_torrents(mongo.db, limit, max_access_count)
+        lease_timeout = request.args.get("lease_timeout", default=10 * 60, type=int)
+        score_weights = {name: request.args.get(name + "_weight", type=float)
+                         for name in LOADING_SCORE_WEIGHTS
+                         if request.args.get(name + "_weight", type=float) is not None}
+        with_peers = request.args.get(
+            "with_peers", default="false", type=str).lower() == "true"
 
-        if inc_access_count:
-            db_increase_access_count(mongo.db, db_lock, result)
+        # Fetched info_hashes are claimed (leased) by caller
+        result = db_fetch_not_indexed_torrents(mongo.db, limit, with_peers, lease_timeout=lease_timeout,
+                                               score_weights=score_weights)
 
         return jsonify({"result": result})
 
+    @app.route("/api/cache_stats")
+    def api_cache_stats():
+        return jsonify({"result": result_cache.stats()})
+
     @app.route("/api/load_routing_table")
     def api_load_routing_table():
         local_node_host = request.args.get("local_node_host", default=None, type=str)
@@ -112,7 +195,7 @@ def start_api_server(mongodb_uri, host, port):
 
         if local_node_host and local_node_port:
             result = db_load_routing_table(mongo.db, db_lock, local_node_host, local_node_port,
-                                           local_node_id)
+                                           local_node_id if is_info_hash(local_node_id) else None)
 
             if result:
                 return jsonify({"result": result})
@@ -132,8 +215,12 @@ def start_api_server(mongodb_uri, host, port):
         local_node_port = request.form.get("local_node_port", default=None, type=int)
 
         if buckets and local_node_id and local_node_host and local_node_port:
-            db_store_routing_table(mongo.db, db_lock, buckets, local_node_id, local_node_host,
-                                   local_node_port)
+            try:
+                db_store_routing_table(mongo.db, db_lock, buckets, local_node_id, local_node_host,
+                                       local_node_port)
+            except ValueError:
+                return jsonify({"result": {"code": 500, "message": "invalid node id"}})
+
             return jsonify({"result": {"code": 200, "message": "OK"}})
         else:
             return jsonify({"result": {
@@ -0,0 +1,103 @@
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+
+
+class TTLCache(object):
+    """
+    Thread safe in-process LRU cache, entries expire in "ttl" seconds.
+    Least recently used entries are evicted when cache holds more than "max_size" entries.
+    """
+
+    def __init__(self, ttl=60, max_size=10000):
+        self._ttl = ttl
+        self._max_size = max_size
+
+        self._items = OrderedDict()  # key -> (expiration time, value), least recently used first
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+
+            if item is None or item[0] < time():
+                self.misses += 1
+                return default
+
+            self._items[key] = item
+            self.hits += 1
+
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time() + self._ttl, value)
+
+            if len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+
+class MongoCache(object):
+    """
+    Out-of-process cache in mongodb collection, shared by web server and api server processes
+    (entries invalidated by api server are invalidated for web server too).
+    Expired entries are removed by TTL index (see "deploy_schema"), so collection size is bounded by
+    "ttl" and requests rate. Keys must be json serializable, values - bson serializable.
+    """
+
+    def __init__(self, collection, ttl=60):
+        self._collection = collection
+        self._ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._collection.find_one({"_id": json.dumps(key),
+                                          "expire_at": {"$gt": datetime.utcnow()}})
+
+        if item is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return item["value"]
+
+    def set(self, key, value):
+        self._collection.replace_one({"_id": json.dumps(key)},
+                                     {"value": value,
+                                      "expire_at": datetime.utcnow() + timedelta(seconds=self._ttl)},
+                                     upsert=True)
+
+    def delete(self, key):
+        self._collection.delete_one({"_id": json.dumps(key)})
+
+    def clear(self):
+        self._collection.delete_many({})
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": self._collection.count()}
+
+
+def make_result_cache(db, ttl=60, max_size=10000, shared=False):
+    """
+    :param shared: use "result_cache" collection of "db" instead of in-process cache
+    """
+    return MongoCache(db.result_cache, ttl) if shared else TTLCache(ttl, max_size)
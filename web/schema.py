@@ -1,12 +1,42 @@
+from datetime import datetime
+
+from bson import Binary
 from pymongo import MongoClient, TEXT, ASCENDING, DESCENDING
 
 
-def deploy_schema(mongodb_uri):
+def check_ids_format(db, binary_ids):
+    """
+    Compare format of stored info_hashes with configured one, oldest and newest documents are checked,
+    so database, which is not converted by "tools/migrate_binary_ids.py" yet, is detected too.
+
+    :raise RuntimeError: on mismatch
+    """
+    for coll_name in ["hashes", "torrents"]:
+        for direction in [ASCENDING, DESCENDING]:
+            doc = db[coll_name].find_one(filter={"info_hash": {"$exists": True}},
+                                         projection={"_id": False, "info_hash": True},
+                                         sort=[("_id", direction)])
+
+            if doc and isinstance(doc["info_hash"], Binary) != binary_ids:
+                raise RuntimeError(
+                    "Info_hashes in \"{0}\" collection are stored as {1} values, but \"BINARY_IDS = {2}\" "
+                    "is configured, convert database by \"tools/migrate_binary_ids.py\" or fix "
+                    "config".format(coll_name, "binary" if isinstance(doc["info_hash"], Binary) else "hex",
+                                    binary_ids))
+
+
+def deploy_schema(mongodb_uri, binary_ids=False):
+    """
+    :param binary_ids: configured info_hashes format (see "BINARY_IDS" in "api.py"),
+                       server refuses to start if database holds other format
+    """
     mongo_client = MongoClient(mongodb_uri)
     try:
         db = mongo_client.grapefruit
 
-        for coll_name in ["crawler_route", "hashes", "torrents"]:
+        check_ids_format(db, binary_ids)
+
+        for coll_name in ["crawler_route", "hashes", "torrents", "counters", "result_cache", "torrent_files"]:
             if coll_name not in db.collection_names():
                 db.create_collection(coll_name)
 
@@ -22,8 +52,30 @@ def deploy_schema(mongodb_uri):
         hashes = db.hashes
         hashes_indexes = hashes.index_information()
 
+        if "loaded_ready_next_attempt_at" not in hashes_indexes:
+            # Loading queue, schedule info_hashes stored by older versions, due ones are marked "ready" by
+            # next fetch (see "db_fetch_not_indexed_torrents")
+            hashes.update_many({"next_attempt_at": {"$exists": False}},
+                               {"$set": {"next_attempt_at": datetime.utcnow()}})
+            hashes.update_many({"ready": {"$exists": False}},
+                               {"$set": {"ready": False}})
+
+        # Queue indexes of older versions, which scanned leased and backed off info_hashes
+        for index_name in ["loaded_next_attempt_at", "loaded_sightings", "loaded_last_seen"]:
+            if index_name in hashes_indexes:
+                hashes.drop_index(index_name)
+
         for index_info in ({"name": "info_hash", "keys": [("info_hash", ASCENDING)], "unique": True},
-                           {"name": "loaded", "keys": [("loaded", ASCENDING)]}):
+                           {"name": "loaded", "keys": [("loaded", ASCENDING)]},
+                           {"name": "loaded_ready_next_attempt_at", "keys": [("loaded", ASCENDING),
+                                                                             ("ready", ASCENDING),
+                                                                             ("next_attempt_at", ASCENDING)]},
+                           {"name": "loaded_ready_sightings", "keys": [("loaded", ASCENDING),
+                                                                       ("ready", ASCENDING),
+                                                                       ("sightings", DESCENDING)]},
+                           {"name": "loaded_ready_last_seen", "keys": [("loaded", ASCENDING),
+                                                                       ("ready", ASCENDING),
+                                                                       ("last_seen", DESCENDING)]}):
             if index_info["name"] not in hashes_indexes:
                 hashes.create_index(**index_info)
 
@@ -38,8 +90,27 @@ def deploy_schema(mongodb_uri):
                             "default_language": "english"},
                            {"name": "info_hash", "keys": [("info_hash", ASCENDING)], "unique": True},
                            {"name": "access_count", "keys": [("access_count", ASCENDING)]},
-                           {"name": "timestamp", "keys": [("timestamp", DESCENDING)]}):
+                           {"name": "timestamp", "keys": [("timestamp", DESCENDING)]},
+                           {"name": "timestamp_id", "keys": [("timestamp", DESCENDING), ("_id", DESCENDING)]}):
             if index_info["name"] not in torrents_indexes:
                 torrents.create_index(**index_info)
+
+        # Chunks of large files lists
+        if "info_hash_index" not in db.torrent_files.index_information():
+            db.torrent_files.create_index(keys=[("info_hash", ASCENDING), ("index", ASCENDING)],
+                                          name="info_hash_index",
+                                          unique=True)
+
+        # Shared results cache entries are removed when expired
+        if "expire_at" not in db.result_cache.index_information():
+            db.result_cache.create_index(keys=[("expire_at", ASCENDING)],
+                                         name="expire_at",
+                                         expireAfterSeconds=0)
+
+        # Resynchronize incrementally maintained documents counters
+        for coll_name in ["hashes", "torrents"]:
+            db.counters.update_one({"_id": coll_name},
+                                   {"$set": {"count": db[coll_name].count()}},
+                                   upsert=True)
     finally:
         mongo_client.close()
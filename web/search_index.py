@@ -0,0 +1,637 @@
+import os
+import re
+import json
+import zlib
+import mmap
+import heapq
+import struct
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import groupby
+from math import log
+from threading import Lock, Thread
+from time import time, sleep
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from api import db_iter_torrent_files, _id_from_db
+
+TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+EPISODE_RE = re.compile(r"^s(\d{1,3})e(\d{1,4})$")
+
+# Longer tokens (hashes, base64 garbage in file names) are not indexed
+MAX_TOKEN_LENGTH = 64
+
+# Term frequency weight of torrent name tokens, file path tokens weight is 1
+NAME_WEIGHT = 4
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Score is multiplied by 1 + RECENCY_WEIGHT for new torrents, boost halves each RECENCY_HALF_LIFE days
+RECENCY_WEIGHT = 0.5
+RECENCY_HALF_LIFE = 30
+
+# Only this number of newest matches of each segment is ranked
+MAX_RANKED = 1000
+
+# Documents numbers of postings are read from memory map by blocks
+_BLOCK_SIZE = 128
+
+_SEGMENT_MAGIC = "GFIDX001"
+_HEADER = struct.Struct("<8sIIQQQqq")  # magic, docs, terms, docs offset, terms offset, total length, min/max ts
+_DOC = struct.Struct("<12sqI")  # ObjectId, timestamp (ms), document length
+_TERM = struct.Struct("<IQ")  # documents frequency, postings offset
+_OFFSET = struct.Struct("<Q")
+_NUMBER = struct.Struct("<I")
+_FREQ = struct.Struct("<H")
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def tokenize(text):
+    """
+    Lowercase words, split on any punctuation ("Some.Show.S01E02.1080p" -> some, show, s01e02, s01, e02, 1080p),
+    words longer than "MAX_TOKEN_LENGTH" are dropped.
+    """
+    tokens = []
+
+    for token in TOKEN_RE.findall(text.lower()):
+        if len(token) > MAX_TOKEN_LENGTH:
+            continue
+
+        tokens.append(token)
+
+        match = EPISODE_RE.match(token)
+        if match:
+            tokens.extend(("s" + match.group(1), "e" + match.group(2)))
+
+    return tokens
+
+
+def _to_ms(value):
+    delta = value - _EPOCH
+    return delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds // 1000
+
+
+def _term_key(term):
+    return term.encode("utf-8") if isinstance(term, unicode) else term
+
+
+class Segment(object):
+    """
+    Immutable on-disk index segment, read through memory map.
+
+    Layout: header, documents table (ordered by timestamp, newest first), postings (documents numbers
+    array and term frequencies array for each term), term entries and sorted terms offsets table,
+    which is searched by bisection, so nothing but header is loaded into memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.docs_count, self.terms_count, self._docs_offset, self._terms_offset, self.total_length,
+         self.min_timestamp, self.max_timestamp) = _HEADER.unpack_from(self._mm, 0)
+
+        if magic != _SEGMENT_MAGIC:
+            raise ValueError("Invalid index segment")
+
+    def _term_at(self, index):
+        offset = _OFFSET.unpack_from(self._mm, self._terms_offset + index * _OFFSET.size)[0]
+        length = struct.unpack_from("<H", self._mm, offset)[0]
+        term = self._mm[offset + 2: offset + 2 + length]
+        doc_freq, postings_offset = _TERM.unpack_from(self._mm, offset + 2 + length)
+
+        return term, doc_freq, postings_offset
+
+    def lookup(self, term):
+        """
+        :return: (documents frequency, postings offset) or None
+        """
+        lo, hi = 0, self.terms_count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_term, doc_freq, postings_offset = self._term_at(mid)
+
+            if mid_term < term:
+                lo = mid + 1
+            elif mid_term > term:
+                hi = mid
+            else:
+                return doc_freq, postings_offset
+
+        return None
+
+    def postings(self, doc_freq, postings_offset):
+        """
+        :return: copy of (documents numbers array, frequencies array)
+        """
+        docs, freqs = array("I"), array("H")
+
+        docs.fromstring(self._mm[postings_offset: postings_offset + doc_freq * docs.itemsize])
+        freqs.fromstring(self._mm[postings_offset + doc_freq * docs.itemsize:
+                                  postings_offset + doc_freq * (docs.itemsize + freqs.itemsize)])
+
+        return docs, freqs
+
+    def postings_view(self, doc_freq, postings_offset):
+        return _PostingsView(self._mm, doc_freq, postings_offset)
+
+    def doc(self, number):
+        """
+        :return: (ObjectId bytes, timestamp ms, document length)
+        """
+        return _DOC.unpack_from(self._mm, self._docs_offset + number * _DOC.size)
+
+    def iter_terms(self):
+        for index in xrange(self.terms_count):
+            yield self._term_at(index)
+
+
+def write_segment(path, docs, postings):
+    """
+    :param docs: iterable of (ObjectId bytes, timestamp ms, document length), newest first
+    :param postings: iterable of (term (utf-8), documents numbers array, frequencies array) ordered by term,
+                     ascending numbers
+    """
+    docs_count, total_length, min_timestamp, max_timestamp = 0, 0, None, None
+    terms = []  # (term, documents frequency, postings offset)
+
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write("\0" * _HEADER.size)
+
+            docs_offset = f.tell()
+            for doc in docs:
+                f.write(_DOC.pack(*doc))
+
+                docs_count += 1
+                total_length += doc[2]
+                min_timestamp = doc[1] if min_timestamp is None else min(min_timestamp, doc[1])
+                max_timestamp = doc[1] if max_timestamp is None else max(max_timestamp, doc[1])
+
+            for term, docs_array, freqs_array in postings:
+                terms.append((term, len(docs_array), f.tell()))
+                f.write(docs_array.tostring())
+                f.write(freqs_array.tostring())
+
+            term_offsets = []
+            for term, doc_freq, postings_offset in terms:
+                term_offsets.append(f.tell())
+                f.write(struct.pack("<H", len(term)) + term)
+                f.write(_TERM.pack(doc_freq, postings_offset))
+
+            terms_offset = f.tell()
+            for offset in term_offsets:
+                f.write(_OFFSET.pack(offset))
+
+            f.seek(0)
+            f.write(_HEADER.pack(_SEGMENT_MAGIC, docs_count, len(terms), docs_offset, terms_offset,
+                                 total_length, min_timestamp or 0, max_timestamp or 0))
+
+        os.rename(path + ".tmp", path)
+    except Exception:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+
+        raise
+
+
+def build_segment(path, torrents):
+    """
+    :param torrents: list of (ObjectId bytes, timestamp ms, name, list of file paths)
+    """
+    torrents = sorted(torrents, key=lambda torrent: torrent[1], reverse=True)
+
+    docs, postings = [], {}
+
+    for number, (oid, timestamp, name, paths) in enumerate(torrents):
+        freqs = {}
+
+        name_tokens = tokenize(name)
+        for token in name_tokens:
+            freqs[token] = freqs.get(token, 0) + NAME_WEIGHT
+
+        length = len(name_tokens) * NAME_WEIGHT
+        for file_path in paths:
+            path_tokens = tokenize(file_path)
+            length += len(path_tokens)
+
+            for token in path_tokens:
+                freqs[token] = freqs.get(token, 0) + 1
+
+        docs.append((oid, timestamp, min(length, 0xffffffff)))
+
+        for token, freq in freqs.iteritems():
+            docs_array, freqs_array = postings.setdefault(_term_key(token), (array("I"), array("H")))
+            docs_array.append(number)
+            freqs_array.append(min(freq, 0xffff))
+
+    write_segment(path, docs, ((term,) + postings[term] for term in sorted(postings)))
+
+
+def merge_segments(path, segments):
+    """
+    Merge segments into new one, documents are renumbered by timestamp, duplicates are dropped.
+
+    Documents and terms of segments are already ordered, so they are merged by streaming, only postings
+    of one term are held in memory.
+    """
+    # Documents numbers of each segment in merged segment, -1 for dropped duplicates
+    numbers = map(lambda segment: array("i", [-1]) * segment.docs_count, segments)
+
+    def iter_docs():
+        seen = set()
+        merged = heapq.merge(*map(lambda (segment_index, segment): (
+            (-segment.doc(number)[1], segment_index, number) for number in xrange(segment.docs_count)),
+            enumerate(segments)))
+
+        for _, segment_index, number in merged:
+            oid, timestamp, length = segments[segment_index].doc(number)
+
+            if oid not in seen:
+                seen.add(oid)
+                numbers[segment_index][number] = len(seen) - 1
+                yield oid, timestamp, length
+
+    def iter_postings():
+        terms = heapq.merge(*map(lambda (segment_index, segment): (
+            (term, segment_index, doc_freq, postings_offset)
+            for term, doc_freq, postings_offset in segment.iter_terms()), enumerate(segments)))
+
+        for term, items in groupby(terms, key=lambda item: item[0]):
+            # Renumbering keeps order of documents of each segment, so postings are merged as sorted lists
+            docs_array, freqs_array = array("I"), array("H")
+
+            for number, freq in heapq.merge(*map(lambda (_, segment_index, doc_freq, postings_offset): (
+                    (numbers[segment_index][number], freq)
+                    for number, freq in zip(*segments[segment_index].postings(doc_freq, postings_offset))
+                    if numbers[segment_index][number] >= 0), items)):
+                docs_array.append(number)
+                freqs_array.append(freq)
+
+            if docs_array:
+                yield term, docs_array, freqs_array
+
+    # Documents are written (and renumbered) before postings are read
+    write_segment(path, iter_docs(), iter_postings())
+
+
+class SearchIndex(object):
+    """
+    Inverted index search backend for torrents names and file paths.
+
+    Index is a set of immutable segments listed in "manifest.json" of index directory. Writer process
+    builds new segment from torrents stored since last update and merges small segments in background
+    thread, reader processes reopen manifest when it changes. Queries match torrents containing all
+    query terms, ranked by BM25 with recency boost.
+    """
+
+    def __init__(self, path, writable=False, refresh_interval=5, merge_factor=8, batch_size=50000, delay=10):
+        """
+        :param writable: only one process (api server) writes index
+        :param refresh_interval: seconds between index updates (writer) or manifest checks (reader)
+        :param merge_factor: segments are merged, when index has more segments
+        :param batch_size: max torrents count in new segment
+        :param delay: seconds, torrents are indexed when they are older, so torrents stored slightly out of
+                      timestamp order (by concurrent requests) are not skipped
+        """
+        self._path = path
+        self._writable = writable
+        self._refresh_interval = refresh_interval
+        self._merge_factor = merge_factor
+        self._batch_size = batch_size
+        self._delay = timedelta(seconds=delay)
+
+        self._lock = Lock()
+        self._segments = []  # Newest first
+        # Torrents are indexed in (timestamp, _id) order, "last_timestamp" and "last_id" are the last indexed
+        self._manifest = {"segments": [], "last_timestamp": 0, "last_id": None, "generation": 0}
+        self._manifest_mtime = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.reload()
+
+    def _manifest_path(self):
+        return os.path.join(self._path, "manifest.json")
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self._manifest_path())
+        except OSError:
+            return
+
+        if mtime == self._manifest_mtime:
+            return
+
+        with open(self._manifest_path(), "r") as f:
+            manifest = json.load(f)
+
+        opened = {segment.name: segment for segment in self._segments}
+        segments = map(lambda name: opened.get(name, None) or Segment(os.path.join(self._path, name)),
+                       manifest["segments"])
+
+        with self._lock:
+            self._manifest, self._manifest_mtime = manifest, mtime
+            self._segments = sorted(segments, key=lambda segment: segment.max_timestamp, reverse=True)
+
+    def _store_manifest(self, manifest):
+        with open(self._manifest_path() + ".tmp", "w") as f:
+            json.dump(manifest, f)
+
+        os.rename(self._manifest_path() + ".tmp", self._manifest_path())
+        self.reload()
+
+    def _new_segment_name(self, manifest):
+        manifest["generation"] += 1
+        return "segment_{0:08d}.idx".format(manifest["generation"])
+
+    def update(self, db):
+        """
+        Index next batch of torrents stored since last update, malformed torrents are skipped.
+
+        :return: count of read torrents, 0 if index is up to date
+        """
+        manifest = dict(self._manifest)
+        manifest.pop("recent_ids", None)  # Written by older versions
+
+        query_filter = {"timestamp": {"$lt": datetime.utcnow() - self._delay},
+                        "name": {"$exists": True}}
+
+        last_timestamp = _EPOCH + timedelta(milliseconds=manifest["last_timestamp"])
+        if manifest.get("last_id"):
+            query_filter["$or"] = [{"timestamp": {"$gt": last_timestamp}},
+                                   {"timestamp": last_timestamp, "_id": {"$gt": ObjectId(manifest["last_id"])}}]
+        elif manifest["last_timestamp"]:
+            query_filter["timestamp"]["$gt"] = last_timestamp
+
+        cursor = db.torrents.find(
+            filter=query_filter,
+            projection={"_id": True, "info_hash": True, "timestamp": True, "name": True, "files.path": True,
+                        "files_chunks": True},
+            sort=[("timestamp", ASCENDING), ("_id", ASCENDING)],
+            limit=self._batch_size)
+
+        torrents, last_doc, read_count = [], None, 0
+        for doc in cursor:
+            last_doc, read_count = doc, read_count + 1
+
+            try:
+                if not isinstance(doc["name"], basestring):
+                    raise TypeError("name is not a string")
+
+                files = db_iter_torrent_files(db, dict(doc, info_hash=_id_from_db(doc["info_hash"])))
+                torrents.append((doc["_id"].binary, _to_ms(doc["timestamp"]), doc["name"],
+                                 map(lambda f: u"/".join(f.get("path", [])), files)))
+            except (KeyError, TypeError, ValueError, AttributeError, zlib.error) as e:
+                print "SearchIndex skipped torrent {0}: {1}".format(doc["_id"], e)
+
+        if not last_doc:
+            return 0
+
+        if torrents:
+            name = self._new_segment_name(manifest)
+            build_segment(os.path.join(self._path, name), torrents)
+            manifest["segments"] = manifest["segments"] + [name]
+
+        manifest["last_timestamp"] = _to_ms(last_doc["timestamp"])
+        manifest["last_id"] = str(last_doc["_id"])
+
+        self._store_manifest(manifest)
+
+        return read_count
+
+    def merge(self):
+        """
+        Merge smallest segments, when index has more than "merge_factor" segments.
+        """
+        segments = sorted(self._segments, key=lambda segment: segment.docs_count)
+        if len(segments) <= self._merge_factor:
+            return
+
+        merged = segments[:self._merge_factor]
+
+        manifest = dict(self._manifest)
+        name = self._new_segment_name(manifest)
+        merge_segments(os.path.join(self._path, name), merged)
+
+        merged_names = set(map(lambda segment: segment.name, merged))
+        manifest["segments"] = [segment_name for segment_name in manifest["segments"]
+                                if segment_name not in merged_names] + [name]
+
+        self._store_manifest(manifest)
+
+        # Readers keep their memory maps of removed files until reopening manifest
+        for segment in merged:
+            os.remove(segment.path)
+
+    def search(self, query, limit, key=None, after=True, max_ranked=MAX_RANKED, max_count=None):
+        """
+        :param key: (score, timestamp ms, ObjectId bytes) of page edge, first page if omitted
+        :param after: page follows "key" in ranking order (precedes otherwise)
+        :param max_count: stop counting matches after "max_count" (count is "max_count" + 1 or more then),
+                          all matches are counted if omitted
+        :return: (matches count, up to "limit" (score, timestamp ms, ObjectId bytes) in ranking order)
+        """
+        with self._lock:
+            segments = self._segments
+
+        terms = list(set(map(_term_key, tokenize(query))))
+
+        docs_count = sum(map(lambda segment: segment.docs_count, segments))
+        if not terms or not docs_count:
+            return 0, []
+
+        avg_length = float(sum(map(lambda segment: segment.total_length, segments))) / docs_count
+
+        lookups = map(lambda segment: map(segment.lookup, terms), segments)
+
+        idfs = []
+        for index in xrange(len(terms)):
+            doc_freq = sum(map(lambda segment_lookups: segment_lookups[index][0] if segment_lookups[index] else 0,
+                               lookups))
+            if not doc_freq:
+                return 0, []
+
+            idfs.append(log(1 + (docs_count - doc_freq + 0.5) / (doc_freq + 0.5)))
+
+        # Recency is counted from the start of current hour, so scores are stable between pages
+        now = int(time() // 3600) * 3600000
+        matches_count, ranked = 0, []
+
+        for segment, segment_lookups in zip(segments, lookups):
+            if not all(segment_lookups):
+                continue
+
+            # Document at a time intersection: candidates of the rarest term are looked up in postings of other
+            # terms, which are read from memory map in place. Candidates are ordered by timestamp (newest first),
+            # so walk stops, when newest "max_ranked" matches are ranked and "max_count" matches are counted
+            postings = sorted(map(lambda (index, lookup): (idfs[index], segment.postings_view(*lookup)),
+                                  enumerate(segment_lookups)), key=lambda item: len(item[1]))
+            views = map(lambda item: item[1], postings)
+
+            if len(views) == 1:
+                # Single term matches are counted by documents frequency
+                matches_count += len(views[0])
+                matches = ((index, []) for index in xrange(min(len(views[0]), max_ranked)))
+            else:
+                matches = _intersect(views[0], views[1:])
+
+            ranked_count = 0
+
+            for rarest_index, positions in matches:
+                if len(views) > 1:
+                    matches_count += 1
+
+                if ranked_count >= max_ranked:
+                    if max_count is not None and matches_count > max_count:
+                        break
+
+                    continue
+
+                ranked_count += 1
+
+                oid, timestamp, length = segment.doc(views[0][rarest_index])
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+
+                score = 0.0
+                for (idf, view), position in zip(postings, [rarest_index] + positions):
+                    freq = view.freq(position)
+                    score += idf * freq * (BM25_K1 + 1) / (freq + norm)
+
+                score *= 1 + RECENCY_WEIGHT * 0.5 ** (max(now - timestamp, 0) / (RECENCY_HALF_LIFE * 86400000.0))
+
+                item = (score, timestamp, oid)
+                if key is None or (item < key if after else item > key):
+                    ranked.append(item)
+
+        if after:
+            return matches_count, heapq.nlargest(limit, ranked)
+        else:
+            return matches_count, sorted(heapq.nsmallest(limit, ranked), reverse=True)
+
+    def __worker(self, db):
+        while True:
+            try:
+                if self._writable:
+                    while self.update(db):
+                        pass
+
+                    self.merge()
+                else:
+                    self.reload()
+            except Exception as e:
+                print "SearchIndex error: {0}".format(e)
+
+            sleep(self._refresh_interval)
+
+    def start(self, db):
+        worker_thread = Thread(target=self.__worker, args=(db,))
+        worker_thread.daemon = True
+        worker_thread.start()
+
+
+class _PostingsView(object):
+    """
+    Documents numbers and frequencies of one term, read from segment memory map by blocks of "_BLOCK_SIZE"
+    numbers, only blocks around looked up numbers are read.
+    """
+
+    def __init__(self, mm, doc_freq, postings_offset):
+        self._mm = mm
+        self._doc_freq = doc_freq
+        self._offset = postings_offset
+        self._freqs_offset = postings_offset + doc_freq * _NUMBER.size
+
+        self._block_start, self._block = 0, array("I")
+
+    def __len__(self):
+        return self._doc_freq
+
+    def __getitem__(self, index):
+        if not self._block_start <= index < self._block_start + len(self._block):
+            self._load_block(index // _BLOCK_SIZE * _BLOCK_SIZE)
+
+        return self._block[index - self._block_start]
+
+    def _load_block(self, start):
+        offset = self._offset + start * _NUMBER.size
+
+        self._block_start, self._block = start, array("I")
+        self._block.fromstring(self._mm[offset: min(offset + _BLOCK_SIZE * _NUMBER.size, self._freqs_offset)])
+
+    def _block_last(self, block_index):
+        # Last number of block, blocks are searched by it without reading them
+        index = min((block_index + 1) * _BLOCK_SIZE, self._doc_freq) - 1
+        return _NUMBER.unpack_from(self._mm, self._offset + index * _NUMBER.size)[0]
+
+    def freq(self, index):
+        return _FREQ.unpack_from(self._mm, self._freqs_offset + index * _FREQ.size)[0]
+
+    def seek(self, number, lo):
+        """
+        :return: first position of "number" or greater one, starting from "lo" position
+        """
+        if lo >= self._doc_freq:
+            return lo
+
+        blocks_count = (self._doc_freq + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+        block_index = lo // _BLOCK_SIZE
+
+        if self._block_last(block_index) < number:
+            # Galloping search of block, which holds the number
+            step, hi = 1, block_index + 1
+            while hi < blocks_count and self._block_last(hi) < number:
+                block_index, step = hi, step * 2
+                hi = block_index + step
+
+            lo_block, hi_block = block_index + 1, min(hi, blocks_count)
+            while lo_block < hi_block:
+                mid = (lo_block + hi_block) // 2
+                if self._block_last(mid) < number:
+                    lo_block = mid + 1
+                else:
+                    hi_block = mid
+
+            if lo_block >= blocks_count:
+                return self._doc_freq
+
+            block_index, lo = lo_block, lo_block * _BLOCK_SIZE
+
+        if self._block_start != block_index * _BLOCK_SIZE or not self._block:
+            self._load_block(block_index * _BLOCK_SIZE)
+
+        return self._block_start + bisect_left(self._block, number, lo - self._block_start)
+
+
+def _intersect(rarest, views):
+    """
+    :param rarest: postings of the rarest term
+    :param views: postings of other terms
+    :return: iterator of (position in "rarest", positions in "views") of documents, found in all postings
+    """
+    positions = [0] * len(views)
+
+    for index in xrange(len(rarest)):
+        number = rarest[index]
+
+        for view_index, view in enumerate(views):
+            position = positions[view_index] = view.seek(number, positions[view_index])
+
+            if position == len(view):
+                return
+
+            if view[position] != number:
+                break
+        else:
+            yield index, list(positions)
@@ -22,6 +22,36 @@ def get_files_size(files):
     return sizeof_fmt(reduce(lambda r, e: r + e["length"], files, 0))
 
 
+def _file_path_length(f):
+    # Metadata comes from remote peers, malformed entries are summarized as unnamed empty files
+    path = f.get("path", None) if isinstance(f, dict) else None
+    length = f.get("length", None) if isinstance(f, dict) else None
+
+    return (filter(lambda e: isinstance(e, basestring), path) if isinstance(path, list) else [],
+            length if isinstance(length, (int, long)) and not isinstance(length, bool) and length > 0 else 0)
+
+
+def get_files_summary(files, preview_size=10):
+    """
+    Display aggregates, computed once when metadata is stored, so results pages never touch "files" list.
+    """
+    entries = map(_file_path_length, files)
+
+    return {"total_size": sum(map(lambda (path, length): length, entries)),
+            "files_count": len(files),
+            "preview_files": map(lambda (path, length): {"name": "/".join(path),
+                                                         "length": length,
+                                                         "icon": get_file_icon(path[~0] if path else "")},
+                                 entries[:preview_size])}
+
+
+def get_preview_files_list(preview_files):
+    return map(lambda f: {"name": f["name"],
+                          "size": sizeof_fmt(f["length"]),
+                          "icon": f["icon"]},
+               preview_files)
+
+
 def get_file_icon(file_name):
     icons = {
         "image": "fa-file-image-o",
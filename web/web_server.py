@@ -11,28 +11,47 @@ from flask import redirect
 from flask import abort
 from flask import render_template
 from flask import request
+from flask import jsonify
 from flask_pymongo import PyMongo
 
 from schema import deploy_schema
+from cache import make_result_cache
+from search_index import SearchIndex
 
 from markupsafe import Markup
 
 from utils import *
+import api
 from api import *
 
 
-def start_web_server(mongodb_uri, host, port):
+def start_web_server(mongodb_uri, host, port, cache_ttl=60, cache_size=10000, shared_cache=False,
+                     search_index_path=None, search_index_writer=False, binary_ids=False):
     logging.basicConfig(filename=os.devnull,
                         level=logging.DEBUG)
 
-    deploy_schema(mongodb_uri)
+    deploy_schema(mongodb_uri, binary_ids)
+    api.BINARY_IDS = binary_ids
 
     app = Flask(__name__, static_url_path="")
     app.config["MONGO_URI"] = mongodb_uri
 
     mongo = PyMongo(app)
 
+    with app.app_context():
+        result_cache = make_result_cache(mongo.db, cache_ttl, cache_size, shared_cache)
+
+        if search_index_path:
+            search_index = SearchIndex(search_index_path, writable=search_index_writer)
+            search_index.start(mongo.db)
+        else:
+            search_index = None
+
     results_per_page = 10
+    files_per_page = 500
+
+    # Precomputed display aggregates only, see "get_files_summary"
+    results_fields = ["name", "info_hash", "total_size", "files_count", "preview_files"]
 
     @app.template_filter('urlencode')
     def urlencode_filter(s):
@@ -61,69 +80,100 @@ def start_web_server(mongodb_uri, host, port):
         return render_template("index.html",
                                torrents_count=db_get_torrents_count(mongo.db))
 
-    def render_results(source_url, query, page, results, results_count, elapsed_time):
+    def render_results(source_url, query, page, results, results_count, elapsed_time, tokens,
+                       count_is_approximate=False):
         items = list(results)
 
         arguments = {
             "source_url": source_url,
             "query": query,
             "page": page,
-            "total_pages": int(math.ceil(results_count / results_per_page)),
+            "tokens": tokens,
             "total_count": results_count,
+            "count_is_approximate": count_is_approximate,
             "time_elapsed": round(elapsed_time, 3),
             "results": map(lambda item: {
                 "info_hash": item["info_hash"],
                 "title": item["name"],
-                "size": get_files_size(item["files"]),
-                "files": get_files_list(item["files"], first_ten=True),
-                "files_count": len(item["files"])
+                "size": sizeof_fmt(item.get("total_size", 0)),
+                "files": get_preview_files_list(item.get("preview_files", [])),
+                "files_count": item.get("files_count", 0)
             }, items)
         }
 
         return render_template("results.html", **arguments)
 
+    # Page number is shown only, page itself is addressed by "token" argument
     @app.route("/search", defaults={"query": None, "page": 1})
     @app.route("/search/<query>", defaults={"page": 1})
     @app.route("/search/<query>/<int:page>")
     def search(query, page):
         if query:
-            results_count, results, elapsed_time = db_search_torrents(
-                mongo.db,
-                query=query,
-                fields=["name", "files", "info_hash"],
-                limit=results_per_page,
-                offset=(page - 1) * results_per_page
-            )
+            token = request.args.get("token", None)
+            if page > 1 and not token:
+                return redirect(u"/search/{0}".format(query))
+
+            try:
+                results_count, results, elapsed_time, tokens = db_search_torrents(
+                    mongo.db,
+                    query=query,
+                    fields=results_fields,
+                    limit=results_per_page,
+                    token=token,
+                    max_count=SEARCH_MAX_COUNT,
+                    cache=result_cache,
+                    search_backend=search_index
+                )
+            except ValueError:
+                abort(404)
 
-            return render_results("/search", query, page, results, results_count, elapsed_time)
+            return render_results("/search", query, page, results, min(results_count, SEARCH_MAX_COUNT),
+                                  elapsed_time, tokens, results_count > SEARCH_MAX_COUNT)
         else:
             return redirect(u"/search/{0}".format(request.args.get("q")))
 
     @app.route("/latest", defaults={"page": 1})
     @app.route("/latest/<int:page>")
     def latest(page):
-        results_count, results, elapsed_time = db_get_last_torrents(
-            mongo.db,
-            fields=["name", "files", "info_hash"],
-            limit=results_per_page,
-            offset=(page - 1) * results_per_page
-        )
-
-        return render_results("/latest", "", page, results, min(results_count, 100), elapsed_time)
-
-    @app.route("/torrent", defaults={"info_hash": None})
-    @app.route("/torrent/<info_hash>")
-    def torrent(info_hash):
+        token = request.args.get("token", None)
+        if page > 1 and not token:
+            return redirect("/latest")
+
+        try:
+            results_count, results, elapsed_time, tokens = db_get_last_torrents(
+                mongo.db,
+                fields=results_fields,
+                limit=results_per_page,
+                token=token
+            )
+        except ValueError:
+            abort(404)
+
+        return render_results("/latest", "", page, results, results_count, elapsed_time, tokens)
+
+    @app.route("/torrent", defaults={"info_hash": None, "page": 1})
+    @app.route("/torrent/<info_hash>", defaults={"page": 1})
+    @app.route("/torrent/<info_hash>/<int:page>")
+    def torrent(info_hash, page):
         if info_hash:
-            result, _ = db_get_torrent_details(mongo.db, info_hash)
+            if not is_info_hash(info_hash):
+                abort(404)
+
+            result, _ = db_get_torrent_details(mongo.db, info_hash, result_cache,
+                                               files_offset=(max(page, 1) - 1) * files_per_page,
+                                               files_limit=files_per_page)
 
             if result:
                 arguments = {
                     "query": result["name"],
                     "title": result["name"],
-                    "size": get_files_size(result["files"]),
+                    "size": sizeof_fmt(result["total_size"]) if "total_size" in result else
+                    get_files_size(result["files"]),
                     "info_hash": result["info_hash"],
-                    "files": get_files_list(result["files"])
+                    "files": get_files_list(result["files"]),
+                    "files_count": result["files_count"],
+                    "page": max(page, 1),
+                    "total_pages": int(math.ceil(result["files_count"] / files_per_page))
                 }
 
                 return render_template("details.html", **arguments)
@@ -132,4 +182,8 @@ def start_web_server(mongodb_uri, host, port):
         else:
             return redirect("/")
 
+    @app.route("/cache_stats")
+    def cache_stats():
+        return jsonify({"result": result_cache.stats()})
+
     app.run(host=host, port=port, threaded=True)
@@ -5,5 +5,11 @@ if __name__ == '__main__':
     start_web_server(
         mongodb_uri=MONGODB_URI,
         host=WEB_SERVER_HOST,
-        port=WEB_SERVER_PORT
+        port=WEB_SERVER_PORT,
+        cache_ttl=RESULT_CACHE_TTL,
+        cache_size=RESULT_CACHE_SIZE,
+        shared_cache=RESULT_CACHE_SHARED,
+        search_index_path=SEARCH_INDEX_PATH,
+        search_index_writer=SEARCH_INDEX_WRITER,
+        binary_ids=BINARY_IDS
     )
@@ -3,3 +3,18 @@ MONGODB_URI = "mongodb://localhost:27017/grapefruit"
 
 WEB_SERVER_HOST = "0.0.0.0"
 WEB_SERVER_PORT = 8080
+
+# Search results and torrent details cache
+RESULT_CACHE_TTL = 60
+RESULT_CACHE_SIZE = 10000
+# Keep cache in mongodb (shared by web server and api server) instead of process memory
+RESULT_CACHE_SHARED = False
+
+# Built-in search index directory (shared by web server and api server), mongodb fulltext search if None
+SEARCH_INDEX_PATH = None
+# Only one process builds and merges index segments, others reload them
+SEARCH_INDEX_WRITER = False
+
+# Store info_hashes and node ids as 20 bytes binary values instead of hex (halves largest indexes),
+# must be the same for both servers, existing database must be converted by "tools/migrate_binary_ids.py"
+BINARY_IDS = False